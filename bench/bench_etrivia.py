@@ -0,0 +1,296 @@
+"""
+ETrivia benchmarks: message hot path, game lifecycle, theme import and top.
+
+Runs the cog against local stand-ins of discord and the bot (see fakes.py) in a temporary
+directory and prints the results as JSON:
+
+    python bench/bench_etrivia.py --output results.json
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakes  # noqa: E402
+
+SERVER_ID = "1"
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class LagMonitor(object):
+    """
+    Measures how late the event loop wakes up a task sleeping `interval` seconds
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        return {
+            "p50_ms": percentile(self.lags, 50) * 1000 if self.lags else None,
+            "p99_ms": percentile(self.lags, 99) * 1000 if self.lags else None,
+            "max_ms": max(self.lags) * 1000 if self.lags else None,
+        }
+
+
+def write_theme(path: str, count: int):
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(count):
+            f.write("Вопрос номер {} про что-нибудь?`ответ{}\n".format(i, i))
+
+
+def count_db_calls(db):
+    """
+    Count functions run on the db thread by name
+    """
+    calls = collections.Counter()
+    run = db.run
+
+    async def counted(fn, *args):
+        calls[fn.__name__] += 1
+        return await run(fn, *args)
+
+    db.run = counted
+    return calls
+
+
+async def wait_for_questions(cog, channels: list):
+    while any(cog.etrivia_sessions.get(c) is None or cog.etrivia_sessions[c].current_q is None for c in channels):
+        await asyncio.sleep(0.001)
+
+
+async def bench_messages(etrivia, cog, bot, args):
+    """
+    Replay wrong answers across `args.sessions` games plus chatter in channels without a game
+    """
+    cog.settings["ETRIVIA_DELAY"] = 3600
+    cog.settings["ETRIVIA_TIMEOUT"] = 3600
+    channels = ["g{}".format(i) for i in range(args.sessions)]
+    for channel in channels:
+        await cog.start(fakes.Object(message=fakes.make_message("", channel, SERVER_ID, "1")), "bench")
+    await wait_for_questions(cog, channels)
+
+    rnd = random.Random(42)
+    messages = []
+    for i in range(args.messages):
+        if rnd.random() < 0.8:
+            channel = rnd.choice(channels)
+        else:
+            channel = "idle{}".format(rnd.randrange(1000))
+        messages.append(fakes.make_message("наверное это что-то другое {}".format(i), channel, SERVER_ID,
+                                           str(rnd.randrange(2, 500))))
+
+    latencies = []
+    monitor = LagMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    for i, message in enumerate(messages):
+        t = time.perf_counter()
+        await etrivia.check_messages(message)
+        latencies.append(time.perf_counter() - t)
+        if i % 50 == 0:
+            await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+    lag = await monitor.stop()
+
+    for channel in channels:
+        session = cog.etrivia_sessions.get(channel)
+        if session:
+            session.cancel()
+    await asyncio.sleep(0.01)
+    return {
+        "sessions": args.sessions,
+        "messages": len(messages),
+        "messages_per_sec": len(messages) / elapsed,
+        "check_p50_us": percentile(latencies, 50) * 1e6,
+        "check_p99_us": percentile(latencies, 99) * 1e6,
+        "loop_lag": lag,
+    }
+
+
+async def bench_games(etrivia, cog, bot, args):
+    """
+    Play `args.games` concurrent games where a player answers every question as soon as it's asked
+    """
+    etrivia.QUESTION_PAUSE = 0
+    cog.settings["ETRIVIA_MAX_SCORE"] = args.questions
+    cog.settings["ETRIVIA_DELAY"] = 3600
+    cog.settings["ETRIVIA_TIMEOUT"] = 3600
+    channels = ["game{}".format(i) for i in range(args.games)]
+    answer_latencies = []
+    asked = {}
+
+    def on_send(destination, content):
+        session = cog.etrivia_sessions.get(destination.id)
+        if session is None or "**Вопрос" not in content or session.current_q is None:
+            return
+        asked[destination.id] = time.perf_counter()
+        answer = session.current_q["answer"]
+        message = fakes.make_message("это {}".format(answer), destination.id, SERVER_ID, destination.id)
+        bot.loop.create_task(etrivia.check_messages(message))
+
+    def on_answer(destination, content):
+        if destination.id in asked and "You got it" in content:
+            answer_latencies.append(time.perf_counter() - asked.pop(destination.id))
+
+    def hook(destination, content):
+        on_answer(destination, content)
+        on_send(destination, content)
+
+    calls = count_db_calls(cog.db)
+    bot.requests.clear()
+    bot.on_send = hook
+    monitor = LagMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    for channel in channels:
+        await cog.start(fakes.Object(message=fakes.make_message("", channel, SERVER_ID, "1")), "bench")
+    while cog.etrivia_sessions:
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    lag = await monitor.stop()
+    bot.on_send = None
+    await cog.ratings.flush()
+
+    return {
+        "games": args.games,
+        "questions_per_game": args.questions,
+        "games_per_sec": args.games / elapsed,
+        "questions_per_sec": args.games * args.questions / elapsed,
+        "answer_p50_ms": (percentile(answer_latencies, 50) or 0) * 1000,
+        "answer_p99_ms": (percentile(answer_latencies, 99) or 0) * 1000,
+        "db_calls_per_game": {k: v / args.games for k, v in calls.items()},
+        "db_writes_per_game": calls["_save_ratings"] / args.games,
+        "bot_requests_per_game": {k: v / args.games for k, v in bot.requests.items()},
+        "loop_lag": lag,
+    }
+
+
+async def bench_import(etrivia, cog, bot, args):
+    write_theme("data/etrivia/bench_import.txt", args.import_lines)
+    started = time.perf_counter()
+    stats = await cog.db.load_theme("bench_import", "data/etrivia/bench_import.txt", True)
+    elapsed = time.perf_counter() - started
+    return {
+        "lines": stats[0],
+        "rows": stats[1],
+        "seconds": elapsed,
+        "rows_per_sec": stats[1] / elapsed,
+    }
+
+
+async def bench_top(etrivia, cog, bot, args):
+    for i in range(args.ratings):
+        cog.ratings.add("top", fakes.Object(id=str(i), name="player{}".format(i)), 1, i % 97, i % 13)
+    await cog.ratings.flush()
+    calls = count_db_calls(cog.db)
+    cold = []
+    for order in ("wise", "games", "victory"):
+        cog.leaderboard.clear()
+        t = time.perf_counter()
+        await cog.leaderboard.get_top("top", 10, order)
+        cold.append(time.perf_counter() - t)
+    queries = calls["_get_top"]
+    warm = []
+    for i in range(1000):
+        t = time.perf_counter()
+        await cog.leaderboard.get_top("top", 10, "victory")
+        warm.append(time.perf_counter() - t)
+    return {
+        "ratings": args.ratings,
+        "cold_p50_us": percentile(cold, 50) * 1e6,
+        "warm_p50_us": percentile(warm, 50) * 1e6,
+        "warm_p99_us": percentile(warm, 99) * 1e6,
+        "warm_db_queries": calls["_get_top"] - queries,
+    }
+
+
+async def run(args):
+    etrivia = fakes.load_cog()
+    bot = fakes.FakeBot(asyncio.get_event_loop())
+    etrivia.check_folders()
+    etrivia.check_files()
+    write_theme("data/etrivia/bench.txt", max(args.questions * 2, 100))
+    etrivia.setup(bot)
+    cog = bot.cogs[0]
+    await cog.load_file("bench", True)
+    await cog._fill_cache("bench")
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+    try:
+        results["messages"] = await bench_messages(etrivia, cog, bot, args)
+        results["games"] = await bench_games(etrivia, cog, bot, args)
+        results["import"] = await bench_import(etrivia, cog, bot, args)
+        results["top"] = await bench_top(etrivia, cog, bot, args)
+    finally:
+        getattr(cog, "_ETrivia__unload")()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=200, help="concurrent games in the message benchmark")
+    parser.add_argument("--messages", type=int, default=50000, help="messages replayed")
+    parser.add_argument("--games", type=int, default=50, help="concurrent games in the lifecycle benchmark")
+    parser.add_argument("--questions", type=int, default=20, help="questions per game")
+    parser.add_argument("--import-lines", type=int, default=100000, help="lines in the imported theme")
+    parser.add_argument("--ratings", type=int, default=10000, help="rating rows for the top benchmark")
+    parser.add_argument("--output", help="also write JSON results to this file")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="etrivia-bench-")
+    os.chdir(workdir)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(run(args))
+    finally:
+        loop.close()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
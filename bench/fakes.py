@@ -0,0 +1,127 @@
+"""
+Local stand-ins for the environment the cog runs in: the `discord` package, the Red bot object
+and `cogs.utils` (dataIO, checks). Only what etrivia.py uses is implemented.
+"""
+import collections
+import importlib.util
+import json
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = "etrivia_bench"
+
+
+class Object(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class HTTPException(Exception):
+    def __init__(self, response=None, message=""):
+        self.response = response
+        super().__init__(message)
+
+
+class DataIO(object):
+    def load_json(self, filename):
+        with open(filename, encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_json(self, filename, data):
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        return True
+
+    def is_valid_json(self, filename):
+        return os.path.isfile(filename)
+
+
+def _command(*args, **kwargs):
+    def decorator(fn):
+        fn.command = _command
+        fn.group = _command
+        return fn
+    return decorator
+
+
+def _check(**perms):
+    return lambda fn: fn
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install():
+    """
+    Register fake `discord` and `etrivia_bench.utils` modules
+    """
+    discord = _module("discord", HTTPException=HTTPException, Forbidden=type("Forbidden", (HTTPException,), {}),
+                      Object=lambda id: Object(id=id))
+    discord.message = _module("discord.message", Message=Object)
+    discord.ext = _module("discord.ext")
+    discord.ext.commands = _module("discord.ext.commands", group=_command, command=_command)
+    package = _module(PACKAGE, __path__=[])
+    package.utils = _module(PACKAGE + ".utils", __path__=[])
+    package.utils.dataIO = _module(PACKAGE + ".utils.dataIO", dataIO=DataIO())
+    package.utils.checks = _module(PACKAGE + ".utils.checks", mod_or_permissions=_check,
+                                   admin_or_permissions=_check, is_owner=lambda: _check())
+
+
+def load_cog():
+    """
+    Import etrivia.py from the repository as `etrivia_bench.etrivia`
+    """
+    install()
+    name = PACKAGE + ".etrivia"
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, "etrivia.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeBot(object):
+    """
+    Bot which records requests instead of talking to Discord
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.user = Object(id="0", name="ETriviaBench")
+        self.requests = collections.Counter()
+        self.listeners = collections.defaultdict(list)
+        self.cogs = []
+        self.on_send = None  # callback(destination, content)
+
+    async def say(self, content):
+        self.requests["say"] += 1
+
+    async def send_message(self, destination, content):
+        self.requests["send_message"] += 1
+        if self.on_send is not None:
+            self.on_send(destination, content)
+
+    async def send_typing(self, destination):
+        self.requests["send_typing"] += 1
+
+    def add_listener(self, fn, name=None):
+        self.listeners[name or fn.__name__].append(fn)
+
+    def add_cog(self, cog):
+        self.cogs.append(cog)
+
+
+_authors = {}
+
+
+def make_message(content: str, channel_id: str, server_id: str, user_id: str):
+    author = _authors.get(user_id)
+    if author is None:
+        author = _authors[user_id] = Object(id=user_id, name="user" + user_id)
+    return Object(content=content, channel=Object(id=channel_id), server=Object(id=server_id), author=author)
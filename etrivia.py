@@ -2,6 +2,7 @@ import discord
 import math
 from discord.ext import commands
 from random import choice as randchoice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from .utils.dataIO import dataIO
 from .utils import checks
 import time
@@ -12,99 +13,409 @@ import sqlite3
 import glob
 import random
 import operator
+import functools
+import multiprocessing
+import zlib
+import bisect
+import array
+import contextlib
+import hashlib
+import itertools
+import re
+import collections
+import json
+import csv
+import traceback
 
+RATING_FLUSH_INTERVAL = 10  # seconds
+RATING_FLUSH_SIZE = 100  # buffered users
+ASKED_FLUSH_INTERVAL = 30  # seconds between writes of asked questions
+SNAPSHOT_INTERVAL = 10  # seconds between checkpoints of running games
+ENCODING_SAMPLE = 64 * 1024  # bytes checked to guess theme file's encoding
+IMPORT_CHUNK = 1000  # rows per executemany while importing
+LOADALL_WORKERS = None  # processes parsing theme files in loadall, None is the number of CPUs
+LEADERBOARD_SIZE = 10  # players kept in each cached top
+TOP_LIMIT = 100  # players shown by top at most
+QUESTION_CACHE_BUDGET = 1000000  # question ids kept in memory for all themes
+DB_PATH = "ETrivia.db"
+METRICS_INTERVAL = 1  # seconds between event loop lag samples
+METRICS_DUMP_INTERVAL = 60  # seconds between metrics dumps
+METRICS_FILE = "data/etrivia/metrics.json"
+EXPORT_CHUNK = 1000  # rating rows read at once while exporting
+EXPORT_FILE = "data/etrivia/rating_{}.{}"  # server id or "all", format
+MESSAGE_LIMIT = 2000  # Discord's message length limit
+TYPING_INTERVAL = 8  # seconds a typing indicator is considered visible
+SEND_ATTEMPTS = 3
+SEND_RETRY_DELAY = 0.5  # seconds before the first retry, doubled after each attempt
+QUESTION_PAUSE = 3  # seconds between questions
+QUESTION_PREFETCH = 20  # questions loaded per query
+SEARCH_LIMIT = 10  # questions shown by search
+MIX_THEME = "mix"  # questions of all themes
+QUESTION_PREFETCH_LOW = 5  # start loading the next batch when less questions are left in memory
+HINT_SHOWN = " -()"  # answer characters never hidden by hints
 
-class ETrivia(object):
-    """General commands."""
 
-    def __init__(self, bot):
-        self.bot = bot
-        self.etrivia_sessions = []
-        self.themes = {}
-        self.questions = {}
+class ETriviaDB(object):
+    """
+    Data access layer. The sqlite connection lives on a single dedicated thread, coroutines
+    await the public methods instead of blocking the event loop with disk IO.
+    """
 
-        self.file_path = "data/etrivia/settings.json"
-        self.settings = dataIO.load_json(self.file_path)
-        self.dbc = sqlite3.connect("ETrivia.db")
+    def __init__(self, path: str, loop):
+        self.path = path
+        self.loop = loop
+        self.dbc = None
+        self.fts = False  # question_fts search index exists
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.call(self._connect)
+
+    def call(self, fn, *args):
+        """
+        Run `fn` on the db thread and wait for the result. Blocks the caller, use it only at startup
+        """
+        return self.executor.submit(fn, *args).result()
+
+    async def run(self, fn, *args):
+        """
+        Run `fn` on the db thread without blocking the event loop
+        """
+        return await self.loop.run_in_executor(self.executor, functools.partial(fn, *args))
+
+    def close(self):
+        self.executor.submit(self._close)
+        self.executor.shutdown(wait=True)
+
+    def _connect(self):
+        self.dbc = sqlite3.connect(self.path)
         self._prepare_db()
-        # self.import_files()
-        self._fill_cache()
+        self.fts = self.dbc.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'question_fts'").fetchone()[0] > 0
+        self.dbc.commit()
+
+    def _close(self):
         self.dbc.commit()
+        self.dbc.close()
+
+    def _create_search_index(self):
+        """
+        Full-text index of questions, only created if sqlite is built with FTS5
+        """
+        options = [r[0] for r in self.dbc.execute("PRAGMA compile_options")]
+        if "ENABLE_FTS5" not in options:
+            print("ETrivia: sqlite has no FTS5, search will scan questions")
+            return
+        self.dbc.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS question_fts USING fts5(
+            text, answer, content='question', content_rowid='id'
+        )
+        """)
+        self.dbc.execute("INSERT INTO question_fts(question_fts) VALUES('rebuild')")
+
+    # Schema changes, `PRAGMA user_version` is the number of applied migrations.
+    # A migration is a list of statements or functions called with the db
+    MIGRATIONS = [
+        # 1: initial schema
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS theme(
+                `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+                `name` VARCHAR(255) UNIQUE
+            );
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS question(
+                `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+                `theme_id` INTEGER,
+                `text` TEXT NOT NULL,
+                `answer` TEXT NOT NULL,
+                `asked` BOOLEAN,
+                FOREIGN KEY(`theme_id`) REFERENCES `theme`(`id`)
+            );
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS rating (
+                `server_id` VARCHAR(255) NOT NULL,
+                `user_id` VARCHAR(255) NOT NULL,
+                `username` VARCHAR(255),
+                `total_games` INT(11)  DEFAULT 0,
+                `wins` INT(11) DEFAULT 0,
+                `right_answers` INT(11) DEFAULT 0,
+                PRIMARY KEY(`server_id`, `user_id`)
+            );
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS theme_file (
+                `theme_id` INTEGER PRIMARY KEY,
+                `size` INTEGER,
+                `mtime` REAL,
+                `hash` VARCHAR(64),
+                FOREIGN KEY(`theme_id`) REFERENCES `theme`(`id`)
+            );
+            ''',
+        ],
+        # 2: indexes for cache loading and top
+        [
+            "CREATE INDEX IF NOT EXISTS question_theme ON question (theme_id, id)",
+            "CREATE INDEX IF NOT EXISTS rating_answers ON rating (server_id, right_answers)",
+            "CREATE INDEX IF NOT EXISTS rating_wins ON rating (server_id, wins)",
+            "CREATE INDEX IF NOT EXISTS rating_games ON rating (server_id, total_games)",
+        ],
+        # 3: questions asked on servers, see AskedQuestions
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS asked_question (
+                `server_id` VARCHAR(255) NOT NULL,
+                `theme_id` INTEGER NOT NULL,
+                `size` INTEGER NOT NULL,
+                `offset` INTEGER NOT NULL,
+                `stride` INTEGER NOT NULL,
+                `position` INTEGER NOT NULL,
+                `bitmap` BLOB NOT NULL,
+                PRIMARY KEY(`server_id`, `theme_id`)
+            );
+            ''',
+            "CREATE INDEX IF NOT EXISTS asked_question_theme ON asked_question (theme_id)",
+        ],
+        # 4: search
+        [
+            _create_search_index,
+        ],
+        # 5: checkpoints of running games, see SnapshotWriter
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS session_snapshot (
+                `channel_id` VARCHAR(255) PRIMARY KEY,
+                `data` BLOB NOT NULL
+            );
+            ''',
+        ],
+        # 6: history of games, `rating` can be rebuilt from it. Counters collected before are kept
+        # as one row per player
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS game_result (
+                `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+                `server_id` VARCHAR(255) NOT NULL,
+                `channel_id` VARCHAR(255),
+                `theme` VARCHAR(255),
+                `user_id` VARCHAR(255) NOT NULL,
+                `username` VARCHAR(255),
+                `games` INT(11) DEFAULT 0,
+                `wins` INT(11) DEFAULT 0,
+                `right_answers` INT(11) DEFAULT 0,
+                `finished` REAL
+            );
+            ''',
+            '''
+            INSERT INTO game_result (server_id, user_id, username, games, wins, right_answers, finished)
+            SELECT server_id, user_id, username, total_games, wins, right_answers, strftime('%s', 'now')
+            FROM rating
+            ''',
+            "CREATE INDEX IF NOT EXISTS game_result_user ON game_result (server_id, user_id)",
+        ],
+        # 7: asked questions are ordered by a keyed permutation instead of offset + i * stride,
+        # asked bits are kept, cycles continue in a new order
+        [
+            '''
+            CREATE TABLE asked_question_new (
+                `server_id` VARCHAR(255) NOT NULL,
+                `theme_id` INTEGER NOT NULL,
+                `size` INTEGER NOT NULL,
+                `seed` INTEGER NOT NULL,
+                `position` INTEGER NOT NULL,
+                `bitmap` BLOB NOT NULL,
+                PRIMARY KEY(`server_id`, `theme_id`)
+            );
+            ''',
+            '''
+            INSERT INTO asked_question_new (server_id, theme_id, size, seed, position, bitmap)
+            SELECT server_id, theme_id, size, random() & 4611686018427387903, 0, bitmap FROM asked_question
+            ''',
+            "DROP TABLE asked_question",
+            "ALTER TABLE asked_question_new RENAME TO asked_question",
+            "CREATE INDEX IF NOT EXISTS asked_question_theme ON asked_question (theme_id)",
+        ],
+    ]
 
     def _prepare_db(self):
-        self.dbc.execute('''
-        CREATE TABLE IF NOT EXISTS theme(
-            `id` INTEGER PRIMARY KEY AUTOINCREMENT,
-            `name` VARCHAR(255) UNIQUE
-        );
-        ''')
-        self.dbc.execute('''
-        CREATE TABLE IF NOT EXISTS question(
-            `id` INTEGER PRIMARY KEY AUTOINCREMENT,
-            `theme_id` INTEGER,
-            `text` TEXT NOT NULL,
-            `answer` TEXT NOT NULL,
-            `asked` BOOLEAN,
-            FOREIGN KEY(`theme_id`) REFERENCES `theme`(`id`)
-        );
-        ''')
-        self.dbc.execute('''
-        CREATE TABLE IF NOT EXISTS rating (
-            `server_id` VARCHAR(255) NOT NULL,
-            `user_id` VARCHAR(255) NOT NULL,
-            `username` VARCHAR(255),
-            `total_games` INT(11)  DEFAULT 0,
-            `wins` INT(11) DEFAULT 0,
-            `right_answers` INT(11) DEFAULT 0,
-            PRIMARY KEY(`server_id`, `user_id`)
-        );
-        ''')
-        pass
+        self.dbc.execute("PRAGMA journal_mode = WAL")
+        self.dbc.execute("PRAGMA synchronous = NORMAL")
+        version = self.dbc.execute("PRAGMA user_version").fetchone()[0]
+        for version, statements in enumerate(self.MIGRATIONS[version:], version + 1):
+            self.dbc.execute("BEGIN")
+            try:
+                for statement in statements:
+                    if callable(statement):
+                        statement(self)
+                    else:
+                        self.dbc.execute(statement)
+                self.dbc.execute("PRAGMA user_version = {:d}".format(version))
+            except:
+                self.dbc.rollback()
+                raise
+            self.dbc.commit()
 
-    def _fill_cache(self, theme=None):
+    def _get_theme_counts(self, theme: str = None):
+        """
+        :param theme: Theme's name, all themes if omitted
+        :return: dict theme's name -> (theme's id, questions count), themes without questions are skipped
+        """
         c = self.dbc.cursor()
-        q = "SELECT * FROM `theme`"
+        q = "SELECT t.id, t.name, COUNT(q.id) FROM theme t JOIN question q ON q.theme_id = t.id"
         d = tuple()
         if theme:
-            q += " WHERE id=?"
-            d = (theme[0], )
-        else:
-            self.questions.clear()
-        c.execute(q, d)
-        for theme in c.fetchall():
-            c.execute("SELECT id FROM question WHERE theme_id = ?", (theme[0],))
-            if theme[1] in self.questions:
-                self.questions[theme[1]].clear()
-            self.questions[theme[1]] = [v[0] for v in c.fetchall()]
-            random.shuffle(self.questions[theme[1]])
-            if not self.questions[theme[1]]:
-                del self.questions[theme[1]]
-
-    def guess_encoding(self, trivia_list):
-        with open(trivia_list, "rb") as f:
-            try:
-                return chardet.detect(f.read())["encoding"]
-            except:
-                return "ISO-8859-1"
+            q += " WHERE t.name = ?"
+            d = (theme, )
+        c.execute(q + " GROUP BY t.id", d)
+        themes = {t[1]: (t[0], t[2]) for t in c.fetchall()}
+        c.close()
+        return themes
+
+    async def get_theme_counts(self, theme: str = None):
+        return await self.run(self._get_theme_counts, theme)
+
+    def _get_question_ids(self, theme_id: int):
+        c = self.dbc.cursor()
+        c.execute("SELECT id FROM question WHERE theme_id = ?", (theme_id,))
+        ids = [v[0] for v in c.fetchall()]
+        c.close()
+        return ids
 
-    def get_theme(self, theme):
+    async def get_question_ids(self, theme_id: int):
+        return await self.run(self._get_question_ids, theme_id)
+
+    def _get_theme(self, theme):
         c = self.dbc.cursor()
         c.execute("SELECT * FROM theme WHERE name = ?", (theme,))
         t = c.fetchone()
         c.close()
         return t
 
-    def flush_questions(self, theme_id: int):
+    def _flush_questions(self, theme_id: int):
+        if self.fts:
+            # the index doesn't store the content, deleted rows must be passed with their values
+            self.dbc.execute("""
+            INSERT INTO question_fts(question_fts, rowid, text, answer)
+            SELECT 'delete', id, text, answer FROM question WHERE theme_id = ?
+            """, (theme_id,))
         self.dbc.execute("DELETE FROM question WHERE theme_id = ?", (theme_id,))
+        # positions in the theme's pool change with the questions
+        self.dbc.execute("DELETE FROM asked_question WHERE theme_id = ?", (theme_id,))
 
-    def get_top(self, server_id: int, limit: int, order: str):
+    def _create_theme_if_not_exists(self, theme: str):
         """
-        :param server_id:
-        :param limit:
-        :param order: Order criteria, available are `wise`, `games`, `victory`
+        Create theme if not exists
+        :param theme:
         :return:
         """
+        db_theme = self._get_theme(theme)
+        is_new = False
+        if db_theme is None:
+            self.dbc.execute("INSERT INTO theme (name) VALUES(?)", (theme,))
+            db_theme = self._get_theme(theme)
+            is_new = True
+        return is_new, db_theme
+
+    def _insert_questions(self, theme_id: int, questions):
+        """
+        :param questions: iterable of (question, answer), inserted `IMPORT_CHUNK` rows per executemany
+        """
+        rows = ((theme_id, question, answer) for question, answer in questions)
+        query = "INSERT INTO question(`theme_id`, `text`, `answer`) VALUES(?, ?, ?)"
+        chunk = list(itertools.islice(rows, IMPORT_CHUNK))
+        while chunk:
+            self.dbc.executemany(query, chunk)
+            chunk = list(itertools.islice(rows, IMPORT_CHUNK))
+        if self.fts:
+            # the theme's old questions are flushed before the import, so all of them are new
+            self.dbc.execute("""
+            INSERT INTO question_fts(rowid, text, answer)
+            SELECT id, text, answer FROM question WHERE theme_id = ?
+            """, (theme_id,))
+
+    def _import_file(self, file_name: str, theme_id: int):
+        """
+        Stream questions from the file into the db
+        :return: tuple (lines read, questions inserted)
+        """
+        stats = [0, 0]
+        self._insert_questions(theme_id, parse_theme_file(file_name, stats))
+        return stats[0], stats[1]
+
+    def _save_theme_file(self, theme_id: int, size: int, mtime: float, digest: str):
+        self.dbc.execute("INSERT OR REPLACE INTO theme_file (theme_id, size, mtime, hash) VALUES (?, ?, ?, ?)",
+                         (theme_id, size, mtime, digest))
+
+    def _get_theme_files(self):
+        """
+        :return: dict theme's name -> (size, mtime, hash) of the file it was imported from
+        """
         c = self.dbc.cursor()
+        c.execute("SELECT t.name, f.size, f.mtime, f.hash FROM theme_file f JOIN theme t ON t.id = f.theme_id")
+        files = {r[0]: r[1:] for r in c.fetchall()}
+        c.close()
+        return files
+
+    async def get_theme_files(self):
+        return await self.run(self._get_theme_files)
+
+    @contextlib.contextmanager
+    def _bulk_load(self):
+        """
+        Transaction with relaxed durability for imports, rolled back on error
+        """
+        synchronous = self.dbc.execute("PRAGMA synchronous").fetchone()[0]
+        self.dbc.execute("PRAGMA synchronous = OFF")
+        try:
+            yield
+            self.dbc.commit()
+        except:
+            self.dbc.rollback()
+            raise
+        finally:
+            self.dbc.execute("PRAGMA synchronous = {:d}".format(synchronous))
+
+    def _load_theme(self, theme: str, file_name: str, force: bool):
+        """
+        Import theme's file in a single transaction
+        :param theme: Theme's name
+        :param file_name: Theme's file
+        :param force: reimport the theme if it already exists
+        :return: False if the theme exists and `force` is not set, otherwise (lines read, questions inserted)
+        """
+        with self._bulk_load():
+            is_new, db_theme = self._create_theme_if_not_exists(theme)
+            if not is_new:
+                if not force:
+                    return False
+                self._flush_questions(db_theme[0])
+            st = os.stat(file_name)
+            stats = self._import_file(file_name, db_theme[0])
+            self._save_theme_file(db_theme[0], st.st_size, st.st_mtime, file_digest(file_name))
+        return stats
+
+    def _apply_theme_file(self, theme: str, size: int, mtime: float, digest: str, questions: list):
+        """
+        Store the result of `scan_theme_file`
+        :param questions: parsed questions, None if the content is unchanged and only file's stat is updated
+        """
+        with self._bulk_load():
+            is_new, db_theme = self._create_theme_if_not_exists(theme)
+            if questions is not None:
+                if not is_new:
+                    self._flush_questions(db_theme[0])
+                self._insert_questions(db_theme[0], questions)
+            self._save_theme_file(db_theme[0], size, mtime, digest)
+
+    async def apply_theme_file(self, theme: str, size: int, mtime: float, digest: str, questions: list):
+        await self.run(self._apply_theme_file, theme, size, mtime, digest, questions)
+
+    async def load_theme(self, theme: str, file_name: str, force: bool):
+        return await self.run(self._load_theme, theme, file_name, force)
+
+    def _top_query(self, server_id: int, order: str):
+        """
+        :return: (query, parameters) selecting rating rows in the order of the top
+        """
         query = "SELECT * FROM rating %s ORDER BY "
         if order == "games":
             query += " total_games"
@@ -118,77 +429,848 @@ class ETrivia(object):
             query %= "WHERE server_id = ?"
         else:
             query %= ""
-        query += " DESC"
-        c.execute(query, data)
-        return [{"username": i[2], "games": i[3], "wins": i[4], "answers": i[5]} for i in c.fetchall()]
+        return query + " DESC", data
 
-    def get_themes(self, loaded: bool = True):
-        if loaded:
-            return self.questions.keys()
-        files = glob.glob("data/etrivia/*.txt")
-        return [f[f.rfind(os.sep)+1:-4] for f in files]
+    def _get_top(self, server_id: int, limit: int, order: str):
+        c = self.dbc.cursor()
+        query, data = self._top_query(server_id, order)
+        c.execute(query + " LIMIT ?", data + (limit,))
+        top = [rating_row(i) for i in c.fetchall()]
+        c.close()
+        return top
 
-    def create_theme_if_not_exists(self, theme: str):
+    async def get_top(self, server_id: int, limit: int, order: str):
         """
-        Create theme if not exists
-        :param theme:
+        :param server_id:
+        :param limit:
+        :param order: Order criteria, available are `wise`, `games`, `victory`
         :return:
         """
-        db_theme = self.get_theme(theme)
-        is_new = False
-        if db_theme is None:
-            self.dbc.execute("INSERT INTO theme (name) VALUES(?)", (theme,))
-            db_theme = self.get_theme(theme)
-            is_new = True
-        return is_new, db_theme
+        return await self.run(self._get_top, server_id, limit, order)
 
-    async def load_file(self, theme: str, force: bool):
-        success = False
+    def _get_questions(self, ids: list):
+        """
+        :param ids: question ids, at most `QUESTION_PREFETCH` of them
+        :return: dict id -> question, missing ids are skipped
+        """
+        c = self.dbc.cursor()
+        c.execute("SELECT id, text, answer FROM question WHERE id IN ({})".format(",".join("?" * len(ids))),
+                  tuple(ids))
+        questions = {q[0]: make_question(q[1], q[2], q[0]) for q in c.fetchall()}
+        c.close()
+        return questions
+
+    async def get_questions(self, ids: list):
+        return await self.run(self._get_questions, ids)
+
+    def _get_id_range(self):
+        """
+        :return: (min id, max id) of questions, (None, None) if there are no questions
+        """
+        return self.dbc.execute("SELECT MIN(id), MAX(id) FROM question").fetchone()
+
+    async def get_id_range(self):
+        return await self.run(self._get_id_range)
+
+    def _search(self, query: str, limit: int):
+        """
+        :param query: Words to find in question's text or answer
+        :return: list of (id, theme's name, text, answer)
+        """
+        words = query.split()
+        if not words:
+            return []
+        c = self.dbc.cursor()
+        if self.fts:
+            # every word is quoted, so the user can't break FTS5 query syntax
+            match = " ".join('"{}"'.format(w.replace('"', '""')) for w in words)
+            c.execute("""
+            SELECT q.id, t.name, q.text, q.answer FROM question_fts f
+            JOIN question q ON q.id = f.rowid JOIN theme t ON t.id = q.theme_id
+            WHERE question_fts MATCH ? ORDER BY f.rank LIMIT ?
+            """, (match, limit))
+        else:
+            where = " AND ".join(["(q.text LIKE ? OR q.answer LIKE ?)"] * len(words))
+            args = []
+            for w in words:
+                args += ["%{}%".format(w)] * 2
+            c.execute("""
+            SELECT q.id, t.name, q.text, q.answer FROM question q JOIN theme t ON t.id = q.theme_id
+            WHERE {} LIMIT ?
+            """.format(where), tuple(args) + (limit,))
+        rows = c.fetchall()
+        c.close()
+        return rows
+
+    async def search(self, query: str, limit: int):
+        return await self.run(self._search, query, limit)
+
+    def _save_ratings(self, deltas: dict, results: list = ()):
+        """
+        Apply buffered rating deltas and append finished games to the history in a single transaction
+        :param deltas: dict (server_id, user_id) -> [username, games, wins, answers]
+        :param results: game_result rows (server_id, channel_id, theme, user_id, username, wins, answers, finished)
+        :return:
+        """
         try:
-            if theme is None or theme is "":
-                await self.bot.say("File name is required")
-                return False
+            self.dbc.executemany("""
+            INSERT INTO `game_result` (server_id, channel_id, theme, user_id, username, games, wins, right_answers,
+                finished)
+            VALUES (
+                ?, ?, ?, ?, ?, 1, ?, ?, ?
+            )
+            """, results)
+            self.dbc.executemany("""
+            INSERT OR IGNORE INTO `rating` (server_id, user_id, username)
+            VALUES (
+                ?, ?, ?
+            )
+            """, [(k[0], k[1], d[0]) for k, d in deltas.items()])
+            self.dbc.executemany("""
+            UPDATE `rating` SET username = ?, total_games = total_games + ?, wins = wins + ?,
+                right_answers = right_answers + ?
+            WHERE server_id=? AND user_id=?
+            """, [(d[0], d[1], d[2], d[3], k[0], k[1]) for k, d in deltas.items()])
+        except:
+            self.dbc.rollback()
+            raise
+        self.dbc.commit()
+        return [rating_row(self._get_rating(k[0], k[1])) for k in deltas]
+
+    async def save_ratings(self, deltas: dict, results: list = ()):
+        """
+        :return: updated rating rows
+        """
+        return await self.run(self._save_ratings, deltas, results)
 
-            is_new, theme = self.create_theme_if_not_exists(theme)
+    def _compact(self, server_ids: list, drop_snapshots: bool = False):
+        """
+        Delete history of the servers the bot has left, rebuild `rating` from the history and
+        defragment the db. Points which reached `rating` but not the history (games interrupted
+        without a snapshot, dropped snapshots) are lost
+        :param server_ids: servers to keep, nothing is deleted if it's empty
+        :param drop_snapshots: delete snapshots of interrupted games, they can't be resumed anymore
+        :return: (history rows deleted, rating rows, answers lost)
+        """
+        deleted = 0
+        try:
+            if server_ids:
+                self.dbc.execute("CREATE TEMP TABLE IF NOT EXISTS kept_server (`id` VARCHAR(255) PRIMARY KEY)")
+                self.dbc.execute("DELETE FROM kept_server")
+                self.dbc.executemany("INSERT OR IGNORE INTO kept_server (id) VALUES (?)", [(i,) for i in server_ids])
+                deleted = self.dbc.execute(
+                    "DELETE FROM game_result WHERE server_id NOT IN (SELECT id FROM kept_server)").rowcount
+                self.dbc.execute("DELETE FROM asked_question WHERE server_id NOT IN (SELECT id FROM kept_server)")
+                self.dbc.execute("DELETE FROM rating WHERE server_id NOT IN (SELECT id FROM kept_server)")
+            if drop_snapshots:
+                self.dbc.execute("DELETE FROM session_snapshot")
+            answers = self.dbc.execute("SELECT TOTAL(right_answers) FROM rating").fetchone()[0]
+            self.dbc.execute("DELETE FROM rating")
+            # the bare username column is taken from the row with MAX(id), i.e. the latest name
+            self.dbc.execute("""
+            INSERT INTO rating (server_id, user_id, username, total_games, wins, right_answers)
+            SELECT server_id, user_id, username, games, wins, answers FROM (
+                SELECT server_id, user_id, username, SUM(games) AS games, SUM(wins) AS wins,
+                    SUM(right_answers) AS answers, MAX(id)
+                FROM game_result GROUP BY server_id, user_id
+            )
+            """)
+        except:
+            self.dbc.rollback()
+            raise
+        self.dbc.commit()
+        self.dbc.execute("VACUUM")
+        self.dbc.execute("ANALYZE")
+        ratings, rebuilt = self.dbc.execute("SELECT COUNT(*), TOTAL(right_answers) FROM rating").fetchone()
+        return deleted, ratings, int(answers - rebuilt)
 
-            if theme is None:
-                await self.bot.say("Произошла ошибка. Тема под названием `{}` не была создана".format(theme[1]))
+    async def compact(self, server_ids: list, drop_snapshots: bool = False):
+        return await self.run(self._compact, server_ids, drop_snapshots)
 
-            if not is_new:
-                if not force:
-                    await self.bot.say("Тема уже была импортирована")
-                    return False
-                self.flush_questions(theme[0])
-                theme = theme
+    def _export_ratings(self, file_name: str, fmt: str, server_id: int, order: str):
+        """
+        Write the rating in the top's order to a csv or json file, `EXPORT_CHUNK` rows at a time.
+        Reads a snapshot of the db through its own read-only connection, so it runs outside the db
+        thread and doesn't hold up the games
+        :param server_id: all servers if empty
+        :return: rows written
+        """
+        query, data = self._top_query(server_id, order)
+        count = 0
+        with contextlib.closing(sqlite3.connect(self.path)) as dbc, \
+                open(file_name + ".tmp", "w", encoding="utf-8", newline="") as f:
+            dbc.execute("PRAGMA query_only = ON")
+            c = dbc.execute(query, data)
+            writer = csv.writer(f)
+            if fmt == "csv":
+                writer.writerow(["server_id", "user_id", "username", "games", "wins", "answers"])
+            else:
+                f.write("[")
+            rows = c.fetchmany(EXPORT_CHUNK)
+            while rows:
+                if fmt == "csv":
+                    writer.writerows(rows)
+                else:
+                    f.write(("," if count else "") + "\n" +
+                            ",\n".join(json.dumps(rating_row(r), ensure_ascii=False) for r in rows))
+                count += len(rows)
+                rows = c.fetchmany(EXPORT_CHUNK)
+            if fmt != "csv":
+                f.write("\n]\n")
+        os.replace(file_name + ".tmp", file_name)
+        return count
 
-            filename = "data/etrivia/" + theme[1] + ".txt"
+    async def export_ratings(self, file_name: str, fmt: str, server_id: int, order: str):
+        return await self.loop.run_in_executor(None, self._export_ratings, file_name, fmt, server_id, order)
 
-            if os.path.isfile(filename):
-                self.import_file(filename, theme[0])
-                success = True
-                await self.bot.say("Тема под названием `{}` успешно импортирована из файла".format(theme[1]))
-                return True
+    def _get_rating(self, server_id: int, user_id: str):
+        c = self.dbc.cursor()
+        c.execute("SELECT * FROM rating WHERE server_id = ? AND user_id = ?", (server_id, user_id))
+        r = c.fetchone()
+        c.close()
+        return r
+
+    def _get_asked(self, server_id: int, theme_id: int):
+        c = self.dbc.cursor()
+        c.execute("SELECT * FROM asked_question WHERE server_id = ? AND theme_id = ?", (server_id, theme_id))
+        r = c.fetchone()
+        c.close()
+        return r
+
+    async def get_asked(self, server_id: int, theme_id: int):
+        return await self.run(self._get_asked, server_id, theme_id)
+
+    def _save_asked(self, rows: list):
+        """
+        :param rows: list of `AskedQuestions.row()`
+        """
+        try:
+            self.dbc.executemany("""
+            INSERT OR REPLACE INTO `asked_question` (server_id, theme_id, size, seed, position, bitmap)
+            VALUES (
+                ?, ?, ?, ?, ?, ?
+            )
+            """, rows)
+        except:
+            self.dbc.rollback()
+            raise
+        self.dbc.commit()
+
+    async def save_asked(self, rows: list):
+        await self.run(self._save_asked, rows)
+
+    def _save_snapshots(self, snapshots: list, ended):
+        """
+        Serialize and write sessions' snapshots in a single transaction
+        :param snapshots: list of `TriviaSession.snapshot()`
+        :param ended: channel ids of finished games, their snapshots are deleted
+        """
+        rows = [(s["c"], zlib.compress(json.dumps(s, separators=(",", ":")).encode("utf-8")))
+                for s in snapshots]
+        try:
+            self.dbc.executemany("DELETE FROM session_snapshot WHERE channel_id = ?", [(c,) for c in ended])
+            self.dbc.executemany("INSERT OR REPLACE INTO session_snapshot (channel_id, data) VALUES (?, ?)", rows)
+        except:
+            self.dbc.rollback()
+            raise
+        self.dbc.commit()
+
+    async def save_snapshots(self, snapshots: list, ended):
+        await self.run(self._save_snapshots, snapshots, ended)
+
+    def _get_snapshot_channels(self):
+        c = self.dbc.cursor()
+        c.execute("SELECT channel_id FROM session_snapshot")
+        channels = [r[0] for r in c.fetchall()]
+        c.close()
+        return channels
+
+    def _get_snapshot(self, channel_id: str):
+        """
+        :return: snapshot dict or None
+        """
+        c = self.dbc.cursor()
+        c.execute("SELECT data FROM session_snapshot WHERE channel_id = ?", (channel_id,))
+        r = c.fetchone()
+        c.close()
+        if r is None:
+            return None
+        return json.loads(zlib.decompress(r[0]).decode("utf-8"))
+
+    async def get_snapshot(self, channel_id: str):
+        return await self.run(self._get_snapshot, channel_id)
+
+
+class RatingWriter(object):
+    """
+    Write-behind buffer for the rating table. Deltas are accumulated per (server_id, user_id)
+    and written as one transaction when the buffer grows or after `RATING_FLUSH_INTERVAL` seconds
+    """
+
+    def __init__(self, db: ETriviaDB, loop, leaderboard=None):
+        self.db = db
+        self.loop = loop
+        self.leaderboard = leaderboard
+        self.pending = {}  # (server_id, user_id) -> [username, games, wins, answers]
+        self.results = []  # game_result rows of finished games
+        self._flush_handle = None
+
+    def add(self, server_id: int, user, plus_games: int = 0, plus_answers: int = 0, plus_wins: int = 0):
+        self._merge(server_id, user.id, user.name, plus_games, plus_wins, plus_answers)
+        if len(self.pending) >= RATING_FLUSH_SIZE:
+            self.loop.create_task(self.flush())
+        elif self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(RATING_FLUSH_INTERVAL, self._flush_later)
+
+    def add_results(self, server_id: int, channel_id: str, theme: str, scores: list):
+        """
+        Record a finished game in the history
+        :param scores: list of (user, answers, won)
+        """
+        finished = time.time()
+        self.results.extend((server_id, channel_id, theme, user.id, user.name, int(won), answers, finished)
+                            for user, answers, won in scores)
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(RATING_FLUSH_INTERVAL, self._flush_later)
+
+    def _merge(self, server_id: int, user_id: str, username: str, games: int, wins: int, answers: int):
+        delta = self.pending.get((server_id, user_id))
+        if delta is None:
+            self.pending[(server_id, user_id)] = [username, games, wins, answers]
+        else:
+            delta[0] = username
+            delta[1] += games
+            delta[2] += wins
+            delta[3] += answers
+
+    def _take(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        deltas, results = self.pending, self.results
+        self.pending = {}
+        self.results = []
+        return deltas, results
+
+    def _flush_later(self):
+        self._flush_handle = None
+        self.loop.create_task(self.flush())
+
+    async def flush(self):
+        deltas, results = self._take()
+        if not deltas and not results:
+            return
+        try:
+            rows = await self.db.save_ratings(deltas, results)
+        except:
+            # keep the deltas, they will be retried with the next flush
+            for k, d in deltas.items():
+                self._merge(k[0], k[1], d[0], d[1], d[2], d[3])
+            self.results[:0] = results
+            raise
+        if self.leaderboard is not None:
+            self.leaderboard.update(rows)
+
+    def flush_sync(self):
+        """
+        Blocking flush, used on cog unload when the event loop can't be awaited
+        """
+        deltas, results = self._take()
+        if deltas or results:
+            self.db.call(self.db._save_ratings, deltas, results)
+
+
+class AskedWriter(object):
+    """
+    Keeps `AskedQuestions` of the played themes in memory, changed ones are written
+    as one transaction every `ASKED_FLUSH_INTERVAL` seconds
+    """
+
+    def __init__(self, db: ETriviaDB, loop):
+        self.db = db
+        self.loop = loop
+        self.states = {}  # (server_id, theme_id) -> AskedQuestions
+        self.dirty = set()
+        self._flush_handle = None
+        self.closed = False
+
+    async def get(self, server_id: int, theme_id: int, size: int):
+        """
+        :param size: Questions count of the theme, saved state of a different size is discarded
+        :return: AskedQuestions
+        """
+        key = (server_id, theme_id)
+        state = self.states.get(key)
+        if state is None:
+            row = await self.db.get_asked(server_id, theme_id)
+            state = self.states.get(key)  # could be loaded by another game meanwhile
+            if state is None and row is not None and row[2] == size:
+                state = self.states[key] = AskedQuestions.from_row(row, self)
+        if state is None or state.size != size:
+            state = self.states[key] = AskedQuestions(key, size, self)
+        return state
+
+    def changed(self, state, index: int):
+        # states dropped after a reload are still used by running games, but not saved,
+        # games cancelled on unload give their questions back after the last flush
+        if self.closed or self.states.get(state.key) is not state:
+            return
+        self.dirty.add(state.key)
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(ASKED_FLUSH_INTERVAL, self._flush_later)
+
+    def drop(self, theme_id: int = None):
+        """
+        Forget states of the reloaded theme
+        :param theme_id: all themes if omitted
+        """
+        for key in list(self.states):
+            if theme_id is None or key[1] == theme_id:
+                del self.states[key]
+                self.dirty.discard(key)
+
+    def _take(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        keys = self.dirty
+        self.dirty = set()
+        return keys, [self.states[k].row() for k in keys]
+
+    def _flush_later(self):
+        self._flush_handle = None
+        self.loop.create_task(self.flush())
+
+    async def flush(self):
+        keys, rows = self._take()
+        if not rows:
+            return
+        try:
+            await self.db.save_asked(rows)
+        except:
+            self.dirty |= {k for k in keys if k in self.states}
+            raise
+
+    def flush_sync(self):
+        """
+        Blocking flush, used on cog unload when the event loop can't be awaited.
+        Later changes are not saved
+        """
+        self.closed = True
+        keys, rows = self._take()
+        if rows:
+            self.db.call(self.db._save_asked, rows)
+
+
+class SnapshotWriter(object):
+    """
+    Checkpoints running games every `SNAPSHOT_INTERVAL` seconds, so they survive a reload of the cog
+    or a restart of the bot. Only games changed since the last checkpoint are written, they are
+    serialized on the db thread
+    """
+
+    def __init__(self, db: ETriviaDB, loop, sessions):
+        """
+        :param sessions: function returning running TriviaSessions
+        """
+        self.db = db
+        self.sessions = sessions
+        self.ended = set()  # channel ids
+        self.task = loop.create_task(self.run())
+
+    def discard(self, channel_id: str):
+        self.ended.add(channel_id)
+
+    def _take(self, changed: bool = True):
+        sessions = [s for s in self.sessions() if s.status != "stop" and (s.dirty or not changed)]
+        snapshots = [s.snapshot() for s in sessions]
+        ended = self.ended - {s["c"] for s in snapshots}
+        self.ended = set()
+        return sessions, snapshots, ended
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            sessions, snapshots, ended = self._take()
+            if not snapshots and not ended:
+                continue
+            try:
+                await self.db.save_snapshots(snapshots, ended)
+            except Exception as e:
+                print("ETrivia: can't save games: {}".format(e))
+                self.ended |= ended
+                for session in sessions:
+                    session.dirty = True
+
+    def close(self):
+        """
+        Stop checkpoints and save every running game, used on unload when the event loop can't be awaited
+        """
+        self.task.cancel()
+        sessions, snapshots, ended = self._take(False)
+        try:
+            self.db.call(self.db._save_snapshots, snapshots, ended)
+        except Exception as e:
+            print("ETrivia: can't save games: {}".format(e))
+
+
+class Metrics(object):
+    """
+    Counters, gauges and latency histograms of the running games. Nothing is recorded while disabled
+    """
+    BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)  # seconds
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.histograms = {}  # name -> [counts per bucket, count, sum, max]
+
+    def inc(self, name: str, value: int = 1):
+        if self.enabled:
+            self.counters[name] += value
+
+    def set(self, name: str, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = [[0] * (len(self.BUCKETS) + 1), 0, 0.0, 0.0]
+        h[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        h[1] += 1
+        h[2] += seconds
+        if seconds > h[3]:
+            h[3] = seconds
+
+    def percentile(self, name: str, p: float):
+        """
+        :return: upper bound of the bucket with the p-th percentile, seconds
+        """
+        h = self.histograms.get(name)
+        if not h or not h[1]:
+            return None
+        rank = p / 100.0 * h[1]
+        seen = 0
+        for i, count in enumerate(h[0]):
+            seen += count
+            if seen >= rank:
+                return min(self.BUCKETS[i], h[3]) if i < len(self.BUCKETS) else h[3]
+        return h[3]
+
+    def reset(self):
+        self.started = time.time()
+        self.counters.clear()
+        self.histograms.clear()
+
+    def snapshot(self):
+        return {
+            "enabled": self.enabled,
+            "since": self.started,
+            "time": time.time(),
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "histograms": {
+                name: {
+                    "count": h[1],
+                    "avg": h[2] / h[1] if h[1] else None,
+                    "p50": self.percentile(name, 50),
+                    "p99": self.percentile(name, 99),
+                    "max": h[3],
+                    "buckets": dict(zip([str(b) for b in self.BUCKETS] + ["inf"], h[0])),
+                } for name, h in self.histograms.items()
+            },
+        }
+
+    def format(self):
+        snapshot = self.snapshot()
+        msg = "Metrics for the last {:.0f} s{}\n\n".format(snapshot["time"] - snapshot["since"],
+                                                         "" if self.enabled else " (disabled)")
+        for name, value in sorted(snapshot["gauges"].items()):
+            msg += "{}: {}\n".format(name, value)
+        for name, value in sorted(snapshot["counters"].items()):
+            msg += "{}: {}\n".format(name, value)
+        for name, h in sorted(snapshot["histograms"].items()):
+            msg += "{}: n={} avg={:.3f}ms p50<={:.3f}ms p99<={:.3f}ms max={:.3f}ms\n".format(
+                name, h["count"], h["avg"] * 1000, h["p50"] * 1000, h["p99"] * 1000, h["max"] * 1000)
+        return msg
+
+
+class Leaderboard(object):
+    """
+    Cached top of players per (server_id, order). Rating counters only grow, so the cache is kept
+    current by merging the rows written by `RatingWriter`, without querying the db again.
+    Deltas which are not written yet are merged into the returned top in memory
+    """
+    ORDER_KEYS = {"wise": "answers", "games": "games", "victory": "wins"}
+
+    def __init__(self, db: ETriviaDB):
+        self.db = db
+        self.boards = {}  # (server_id, order) -> [limit, rows]
+
+    async def get_top(self, server_id: int, limit: int, order: str, pending: dict = None):
+        """
+        :param server_id: empty for the top across all servers
+        :param limit:
+        :param order: Order criteria, available are `wise`, `games`, `victory`
+        :param pending: `RatingWriter.pending`
+        :return:
+        """
+        if order not in self.ORDER_KEYS:
+            order = "wise"
+        board = self.boards.get((server_id, order))
+        if board is None or board[0] < limit:
+            size = max(limit, LEADERBOARD_SIZE)
+            board = [size, await self.db.get_top(server_id, size, order)]
+            self.boards[(server_id, order)] = board
+        top = board[1]
+        if pending:
+            top = self._merge_pending(server_id, order, board, pending)
+        return top[:limit]
+
+    def _merge_pending(self, server_id: int, order: str, board: list, pending: dict):
+        """
+        Players of the board get their buffered deltas. Others are added when the board holds every
+        rating row of the server, otherwise they enter the board with the next flush
+        """
+        deltas = {k: d for k, d in pending.items() if not server_id or k[0] == server_id}
+        if not deltas:
+            return board[1]
+        top = []
+        for r in board[1]:
+            delta = deltas.pop((r["server_id"], r["user_id"]), None)
+            top.append(r if delta is None else rating_with_delta(r, delta))
+        if len(board[1]) < board[0]:
+            # the players have no rating yet
+            top.extend(rating_with_delta(rating_row((k[0], k[1], None, 0, 0, 0)), delta)
+                       for k, delta in deltas.items())
+        top.sort(key=operator.itemgetter(self.ORDER_KEYS[order]), reverse=True)
+        return top
+
+    def update(self, rows: list):
+        """
+        :param rows: rating rows after the update
+        """
+        for (server_id, order), board in self.boards.items():
+            changed = [r for r in rows if not server_id or r["server_id"] == server_id]
+            if not changed:
+                continue
+            keys = {(r["server_id"], r["user_id"]) for r in changed}
+            top = [r for r in board[1] if (r["server_id"], r["user_id"]) not in keys] + changed
+            top.sort(key=operator.itemgetter(self.ORDER_KEYS[order]), reverse=True)
+            del top[board[0]:]
+            board[1] = top
+
+    def clear(self):
+        self.boards.clear()
+
+
+class ETrivia(object):
+    """General commands."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.etrivia_sessions = {}  # channel id -> TriviaSession
+        self.themes = {}  # theme's name -> (theme's id, questions count)
+        self.questions = collections.OrderedDict()  # theme's name -> question ids, in LRU order
+
+        self.file_path = "data/etrivia/settings.json"
+        self.settings = dataIO.load_json(self.file_path)
+        self.metrics = Metrics(self.settings["ETRIVIA_METRICS"])
+        self.db = ETriviaDB(DB_PATH, bot.loop)
+        self.leaderboard = Leaderboard(self.db)
+        self.ratings = RatingWriter(self.db, bot.loop, self.leaderboard)
+        self.asked = AskedWriter(self.db, bot.loop)
+        self.snapshots = SnapshotWriter(self.db, bot.loop, lambda: [
+            s for s in self.etrivia_sessions.values() if isinstance(s, TriviaSession)])
+        # games interrupted by a reload, restored when their channel is active again
+        self.suspended = set(self.db.call(self.db._get_snapshot_channels))
+        self.resuming = {}  # channel id -> task restoring the game
+        self.starting = set()  # channel ids of the games being started
+        self.themes = self.db.call(self.db._get_theme_counts)
+        self.monitor_task = bot.loop.create_task(self.monitor())
+
+    def __unload(self):
+        self.monitor_task.cancel()
+        self.snapshots.close()
+        for session in list(self.etrivia_sessions.values()):
+            session.cancel()
+        self.ratings.flush_sync()
+        self.asked.flush_sync()
+        self.db.close()
+
+    async def _fill_cache(self, theme: str = None):
+        """
+        Reload themes' question counts, cached question ids of reloaded themes are dropped
+        :param theme: Theme's name, all themes if omitted
+        """
+        themes = await self.db.get_theme_counts(theme)
+        if theme is None:
+            self.themes = themes
+            self.questions.clear()
+            self.asked.drop()
+        else:
+            if theme in self.themes:
+                self.asked.drop(self.themes[theme][0])
+            self.themes.pop(theme, None)
+            self.themes.update(themes)
+            self.questions.pop(theme, None)
+
+    async def get_questions(self, theme: str):
+        """
+        Question ids of the theme, loaded on first use. Least recently used themes are evicted
+        when more than `QUESTION_CACHE_BUDGET` ids are cached
+        :param theme: Theme's name
+        :return: array of ids or None if there is no such theme. Shared by all sessions, must not be modified
+        """
+        if theme not in self.themes:
+            return None
+        ids = self.questions.get(theme)
+        if ids is not None:
+            self.questions.move_to_end(theme)
+            return ids
+        ids = array.array("l", await self.db.get_question_ids(self.themes[theme][0]))
+        self.questions[theme] = ids
+        cached = sum(len(v) for v in self.questions.values())
+        while cached > QUESTION_CACHE_BUDGET and len(self.questions) > 1:
+            cached -= len(self.questions.popitem(last=False)[1])
+        return ids
+
+    async def start_game(self, message, theme: str, snapshot: dict = None):
+        """
+        :param snapshot: `TriviaSession.snapshot()` of the interrupted game to continue
+        :return: session or None if there are no questions or the channel already has a game
+        """
+        # the channel is claimed before the first await, so concurrent starts can't both pass
+        channel_id = message.channel.id
+        if channel_id in self.starting or self.get_session(message.channel) is not None:
+            return None
+        self.starting.add(channel_id)
+        try:
+            asked = None
+            if snapshot is not None and snapshot["m"] or snapshot is None and theme == MIX_THEME and \
+                    theme not in self.themes:
+                theme = None
+                questions = await self.random_questions()
             else:
-                await self.bot.say("File {} not found".format(filename))
-                return False
+                questions = await self.get_questions(theme)
+                if questions:
+                    asked = await self.asked.get(message.server.id, self.themes[theme][0], len(questions))
+            if not questions:
+                return None
+            if asked is not None:
+                questions = QuestionCursor(questions, asked)
+            t = TriviaSession(self, message, self.settings, questions, theme)
+            t.start(snapshot)
+            self.add_session(t)
+            return t
         finally:
-            if not success:
-                self.dbc.rollback()
-            else:
-                self.dbc.commit()
-
-    def import_file(self, file_name: str, theme_id: int):
-        encoding = self.guess_encoding(file_name)
-        with open(file_name, "r", encoding=encoding) as fin:
-            for line in fin:
-                if "`" in line and len(line) > 4:
-                    line = line.replace("\n", "")
-                    line = line.split("`")
-                    question = line[0]
-                    answer = line[1]
-                    if len(line) >= 2:
-                        self.dbc.execute("INSERT INTO question(`theme_id`, `text`, `answer`) VALUES(?, ?, ?)",
-                                         (theme_id, question, answer))
+            self.starting.discard(channel_id)
+
+    async def resume(self, channel):
+        """
+        Continue the game interrupted in the channel by a reload or a restart
+        :return: session or None if there was no such game
+        """
+        task = self.resuming.get(channel.id)
+        if task is None:
+            if channel.id not in self.suspended:
+                return None
+            self.suspended.discard(channel.id)
+            task = self.resuming[channel.id] = asyncio.ensure_future(self._resume(channel))
+            task.add_done_callback(lambda t: self.resuming.pop(channel.id, None))
+        return await asyncio.shield(task)
+
+    async def _resume(self, channel):
+        snapshot = await self.db.get_snapshot(channel.id)
+        session = None
+        if snapshot is not None:
+            message = ResumeMessage(channel, discord.Object(snapshot["s"]))
+            session = await self.start_game(message, snapshot["t"], snapshot)
+        if session is None:
+            self.snapshots.discard(channel.id)
+        return session
+
+    async def random_questions(self):
+        """
+        :return: RandomQuestions over all themes or None if there are no questions
+        """
+        low, high = await self.db.get_id_range()
+        if low is None:
+            return None
+        return RandomQuestions(low, high, sum(t[1] for t in self.themes.values()))
+
+    async def monitor(self):
+        """
+        Measure event loop lag and periodically dump metrics to `METRICS_FILE`
+        """
+        last_dump = time.perf_counter()
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(METRICS_INTERVAL)
+            if not self.metrics.enabled:
+                continue
+            now = time.perf_counter()
+            self.metrics.observe("loop_lag", max(0.0, now - started - METRICS_INTERVAL))
+            self.metrics.set("sessions", len(self.etrivia_sessions))
+            self.metrics.set("pending_ratings", len(self.ratings.pending))
+            self.metrics.set("cached_themes", len(self.questions))
+            if now - last_dump >= METRICS_DUMP_INTERVAL:
+                last_dump = now
+                try:
+                    await self.bot.loop.run_in_executor(None, dataIO.save_json, METRICS_FILE,
+                                                        self.metrics.snapshot())
+                except Exception as e:
+                    print("ETrivia: can't save metrics: {}".format(e))
+
+    def get_session(self, channel):
+        return self.etrivia_sessions.get(channel.id)
+
+    def add_session(self, session):
+        self.etrivia_sessions[session.channel.id] = session
+        self.metrics.inc("games_started")
+
+    def remove_session(self, session):
+        """
+        Remove session from the registry if it is still the one registered for its channel
+        :param session:
+        :return:
+        """
+        if self.etrivia_sessions.get(session.channel.id) is session:
+            del self.etrivia_sessions[session.channel.id]
+            self.snapshots.discard(session.channel.id)
+            self.metrics.inc("games_finished")
+
+    def get_themes(self, loaded: bool = True):
+        if loaded:
+            return self.themes.keys()
+        files = glob.glob("data/etrivia/*.txt")
+        return [f[f.rfind(os.sep)+1:-4] for f in files]
+
+    async def load_file(self, theme: str, force: bool):
+        if theme is None or theme == "":
+            await self.bot.say("File name is required")
+            return False
+
+        filename = "data/etrivia/" + theme + ".txt"
+        if not os.path.isfile(filename):
+            await self.bot.say("File {} not found".format(filename))
+            return False
+
+        started = time.perf_counter()
+        stats = await self.db.load_theme(theme, filename, force)
+        if not stats:
+            await self.bot.say("Тема уже была импортирована")
+            return False
+        elapsed = time.perf_counter() - started
+        await self.bot.say("Тема под названием `{}` успешно импортирована из файла: {} вопросов из {} строк "
+                           "за {:.2f} с ({:.0f} вопросов/с)".format(theme, stats[1], stats[0], elapsed,
+                                                                   stats[1] / max(elapsed, 1e-6)))
+        return True
 
     @commands.group(pass_context=True)
     async def etrivia(self, ctx):
@@ -207,25 +1289,53 @@ class ETrivia(object):
         """
         await self.bot.say("I'm starting to load theme {}".format(theme))
         await self.load_file(theme, force)
-        self._fill_cache(theme)
+        await self._fill_cache(theme)
         await self.bot.say("Theme {} was loaded successfully!".format(theme))
 
     @etrivia.command()
     @checks.mod_or_permissions(administrator=True)
     async def loadall(self, force: bool = False):
         """
-        Loading all available themes
-        :param force: ignore themes' existence
+        Loading all available themes. Only new and changed files are imported
+        :param force: check content of every file, not only its size and modification time
         :return:
         """
         themes = self.get_themes(False)
         await self.bot.say("I'm starting to load {} themes".format(len(themes)))
-        for idx, theme in enumerate(themes):
-            await self.bot.say("{}. I'm starting to load theme {}".format(idx, theme))
-            if await self.load_file(theme, force):
-                await self.bot.say("Theme {} was loaded successfully".format(theme))
-        self._fill_cache()
-        await self.bot.say("All themes was loaded")
+        started = time.perf_counter()
+        known = await self.db.get_theme_files()
+        to_scan = []
+        for theme in themes:
+            filename = "data/etrivia/" + theme + ".txt"
+            st = os.stat(filename)
+            file_info = known.get(theme)
+            if file_info is not None and not force and file_info[0] == st.st_size and file_info[1] == st.st_mtime:
+                continue
+            to_scan.append((theme, filename, file_info[2] if file_info else None))
+
+        loaded = []
+        questions_count = 0
+        if to_scan:
+            # forking the running bot would copy its threads (the db thread) mid-work
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=LOADALL_WORKERS, mp_context=context) as pool:
+                async def scan(theme, filename, digest):
+                    return theme, await self.bot.loop.run_in_executor(pool, scan_theme_file, filename, digest)
+
+                for future in asyncio.as_completed([scan(*f) for f in to_scan]):
+                    try:
+                        theme, (size, mtime, digest, questions) = await future
+                    except Exception as e:
+                        await self.bot.say("Error while loading theme: {}".format(e))
+                        continue
+                    await self.db.apply_theme_file(theme, size, mtime, digest, questions)
+                    if questions is not None:
+                        loaded.append(theme)
+                        questions_count += len(questions)
+        for theme in loaded:
+            await self._fill_cache(theme)
+        await self.bot.say("All themes was loaded: {} changed of {}, {} questions imported in {:.2f} s".format(
+            len(loaded), len(themes), questions_count, time.perf_counter() - started))
 
     @commands.group(pass_context=True)
     @checks.mod_or_permissions(administrator=True)
@@ -269,14 +1379,105 @@ class ETrivia(object):
             await self.bot.say("I'll gain a point everytime you don't answer in time.")
         dataIO.save_json(self.file_path, self.settings)
 
+    @etriviaset.command()
+    async def hintratio(self, ratio: float):
+        """Part of the hidden letters shown by each hint"""
+        if 0 < ratio <= 1:
+            self.settings["ETRIVIA_HINT_RATIO"] = ratio
+            dataIO.save_json(self.file_path, self.settings)
+            await self.bot.say("Each hint will show {:.0%} of the hidden letters.".format(ratio))
+        else:
+            await self.bot.say("Ratio must be greater than 0 and at most 1.")
+
+    @etriviaset.command()
+    async def hidden(self, letters: int):
+        """Letters left hidden when hints stop"""
+        if letters >= 0:
+            self.settings["ETRIVIA_HINT_MIN_HIDDEN"] = letters
+            dataIO.save_json(self.file_path, self.settings)
+            await self.bot.say("Hints stop when {} letters or less are hidden.".format(letters))
+        else:
+            await self.bot.say("Letters count can't be negative.")
+
+    @etriviaset.command(name="metrics")
+    async def toggle_metrics(self):
+        """Toggle collecting of game metrics"""
+        self.settings["ETRIVIA_METRICS"] = not self.settings["ETRIVIA_METRICS"]
+        self.metrics.enabled = self.settings["ETRIVIA_METRICS"]
+        if self.metrics.enabled:
+            self.metrics.reset()
+            await self.bot.say("Metrics are enabled, see `{}`.".format(METRICS_FILE))
+        else:
+            await self.bot.say("Metrics are disabled.")
+        dataIO.save_json(self.file_path, self.settings)
+
+    @etriviaset.command()
+    @checks.is_owner()
+    async def compact(self, force: bool = False):
+        """
+        Rebuild ratings from the games' history, forget servers the bot has left
+        force - also when there are interrupted games waiting to be resumed, they are dropped
+        and points of their players are lost
+        """
+        if self.etrivia_sessions or self.resuming or self.starting:
+            await self.bot.say("Stop running games first.")
+            return
+        if self.suspended and not force:
+            await self.bot.say("{} interrupted games will be dropped and their points lost, "
+                               "use `compact yes` to continue.".format(len(self.suspended)))
+            return
+        await self.ratings.flush()
+        await self.asked.flush()
+        # games could start during the flushes, points written before the rebuild would be lost.
+        # Later writes are queued after it on the db thread
+        if self.etrivia_sessions or self.resuming or self.starting:
+            await self.bot.say("Games were started meanwhile, stop them first.")
+            return
+        started = time.perf_counter()
+        dropped = len(self.suspended)
+        self.suspended.clear()
+        deleted, ratings, lost = await self.db.compact([s.id for s in self.bot.servers], dropped > 0)
+        self.leaderboard.clear()
+        msg = "Deleted {} results of left servers, {} players rated. Done in {:.2f} s.".format(
+            deleted, ratings, time.perf_counter() - started)
+        if dropped or lost:
+            msg += "\n{} interrupted games dropped, {} answers missing in the history are lost.".format(dropped, lost)
+        await self.bot.say(msg)
+
+    @etriviaset.command(pass_context=True)
+    async def export(self, ctx, fmt: str = "csv", order_by: str = "wise", everything: bool = False):
+        """
+        Export the rating of the server to a file
+        fmt - "csv" or "json"
+        everything - all servers instead of this one
+        """
+        if fmt not in ("csv", "json"):
+            await self.bot.say("Format must be csv or json.")
+            return
+        server_id = "" if everything else ctx.message.server.id
+        file_name = EXPORT_FILE.format(server_id or "all", fmt)
+        await self.ratings.flush()
+        count = await self.db.export_ratings(file_name, fmt, server_id, order_by)
+        try:
+            await self.bot.upload(file_name, content="{} players.".format(count))
+        except discord.HTTPException:
+            await self.bot.say("{} players saved to `{}`, the file can't be uploaded.".format(count, file_name))
+
+    @etriviaset.command()
+    async def stats(self):
+        """Metrics of running games"""
+        self.metrics.set("sessions", len(self.etrivia_sessions))
+        await self.bot.say("```\n{}```".format(self.metrics.format()))
+
     @etrivia.command(pass_context=True)
     async def top(self, ctx, order_by: str = "wise", limit: int = 10):
         """
         Top of the best ETrivia players
         order_by - sorting order. Available are "wise", "games", "victory"
-        limit - limit
+        limit - limit, 100 at most
         """
-        top = self.get_top(ctx.message.server.id, limit, order_by)
+        limit = max(1, min(limit, TOP_LIMIT))
+        top = await self.leaderboard.get_top(ctx.message.server.id, limit, order_by, self.ratings.pending)
         msg = "**Рейтинг игроков:** \n```\n{0:3}\t{1:10}\t{2:5}\t{3:5}\t{4:5}\n".format("#", "Имя", "Игры", "Победы",
                                                                                         "Ответы")
         for idx, player in enumerate(top):
@@ -293,14 +1494,11 @@ class ETrivia(object):
 
     @etrivia.command(pass_context=True)
     async def start(self, ctx, theme: str = None):
-        """Start an etrivia session with the specified theme
+        """Start an etrivia session with the specified theme, `mix` asks questions of all themes
         """
         message = ctx.message
-        if not await get_trivia_by_channel(message.channel):
-            if theme in self.questions:
-                t = TriviaSession(message, self.settings, self.questions[theme], self.dbc)
-                self.etrivia_sessions.append(t)
-                await t.in_game()
+        if not await get_trivia_by_channel(message.channel) and message.channel.id not in self.starting:
+            await self.start_game(message, theme)
         else:
             await self.bot.say("A Etrivia session is already ongoing in this channel.")
 
@@ -312,13 +1510,31 @@ class ETrivia(object):
         :return:
         """
         message = ctx.message
-        if await get_trivia_by_channel(message.channel):
-            s = await get_trivia_by_channel(message.channel)
+        s = await get_trivia_by_channel(message.channel)
+        if s:
             await s.end_game()
+            s.cancel()
             await self.bot.say("Etrivia stopped.")
         else:
             await self.bot.say("There's no Etrivia session ongoing in this channel.")
 
+    @etrivia.command()
+    @checks.mod_or_permissions(administrator=True)
+    async def search(self, *, query: str):
+        """
+        Find questions by words of the text or the answer
+        """
+        rows = await self.db.search(query, SEARCH_LIMIT)
+        if not rows:
+            await self.bot.say("Nothing found.")
+            return
+        msg = "```\n"
+        for r in rows:
+            line = "#{} [{}] {} — {}".format(r[0], r[1], r[2], r[3])
+            msg += line[:(MESSAGE_LIMIT - 10) // SEARCH_LIMIT] + "\n"
+        msg += "```"
+        await self.bot.say(msg)
+
     @etrivia.command(pass_context=True)
     async def list(self, ctx):
         """
@@ -328,9 +1544,9 @@ class ETrivia(object):
 
     async def trivia_list(self, author):
         msg = "**Available Etrivia lists:** \n\n```"
-        if self.questions:
+        if self.themes:
             i = 0
-            for theme in self.questions.keys():
+            for theme in self.themes.keys():
                 if i % 4 == 0 and i != 0:
                     msg += theme + "\n"
                 else:
@@ -345,129 +1561,560 @@ class ETrivia(object):
             await self.bot.say("There are no etrivia lists available.")
 
 
+class QuestionCursor(object):
+    """
+    Questions of a game over a shared pool of question ids without copying it. The order is the
+    server's one kept by `asked`, questions asked in other games are skipped. Taken questions are
+    reserved there until `shown`, the ones never shown are given back by `release`
+    """
+    __slots__ = ("pool", "position", "asked", "taken")
+
+    def __init__(self, pool, asked, position: int = 0):
+        self.pool = pool
+        self.position = position  # questions taken by the game
+        self.asked = asked
+        self.taken = {}  # question id -> position in the pool, taken from `asked` but not shown yet
+
+    def __len__(self):
+        return len(self.pool) - self.position
+
+    def state(self):
+        return [self.position]
+
+    def restore(self, state: list, taken: list = ()):
+        """
+        :param state: `state()`, the position is the last item
+        :param taken: ids of the questions taken before the save and not shown yet
+        """
+        self.position = min(state[-1], len(self.pool))
+        for q_id in taken:
+            try:
+                self.taken[q_id] = self.pool.index(q_id)
+            except ValueError:
+                pass
+
+    def pop(self):
+        """
+        :return: next question id
+        """
+        if self.position >= len(self.pool):
+            raise IndexError("pop from exhausted cursor")
+        self.position += 1
+        i = self.asked.take()
+        self.taken[self.pool[i]] = i
+        return self.pool[i]
+
+    def shown(self, q_id: int):
+        """
+        Mark the question as asked on the server
+        """
+        i = self.taken.pop(q_id, None)
+        if i is not None:
+            self.asked.add(i)
+
+    def release(self):
+        """
+        Give back the taken questions which weren't shown, other games of the server can ask them
+        """
+        for i in self.taken.values():
+            self.asked.discard(i)
+        self.position -= min(len(self.taken), self.position)
+        self.taken.clear()
+
+
+class RandomQuestions(object):
+    """
+    Random question ids of all themes for `MIX_THEME` games. Ids are drawn uniformly from
+    [low, high], ids of deleted questions are skipped by `ETriviaDB.get_questions`, so
+    the corpus is never sorted randomly
+    """
+    __slots__ = ("low", "high", "left", "taken")
+    asked = None
+
+    def __init__(self, low: int, high: int, count: int):
+        self.low = low
+        self.high = high
+        self.left = count
+        self.taken = set()
+
+    def __len__(self):
+        return self.left
+
+    def state(self):
+        return [self.left, sorted(self.taken)]
+
+    def restore(self, state: list, taken: list = ()):
+        self.left = state[0]
+        self.taken = set(state[1])
+
+    def shown(self, q_id: int):
+        pass
+
+    def release(self):
+        pass
+
+    def pop(self):
+        """
+        :return: random question id, None if it was already taken in this game
+        """
+        if self.left <= 0:
+            raise IndexError("pop from exhausted cursor")
+        self.left -= 1
+        i = random.randint(self.low, self.high)
+        if i in self.taken:
+            return None
+        self.taken.add(i)
+        return i
+
+
+class AskedQuestions(object):
+    """
+    Questions of a theme asked on a server, a bit per position in the theme's pool of ids.
+    Games of the server share the order pool[permute(i, size, seed)] and every position
+    before `position` is asked, so each position is stepped over once per cycle. When all
+    questions are asked the bits are cleared and a new order is chosen.
+    `owner.changed(state, index)` is called after each change, index is None on reset
+    """
+    __slots__ = ("key", "size", "owner", "seed", "position", "bits", "count")
+
+    def __init__(self, key: tuple, size: int, owner, seed: int = None, position: int = 0, bits: bytes = None):
+        self.key = key  # (server_id, theme_id)
+        self.size = size
+        self.owner = owner
+        self.position = position
+        self.seed = random_seed() if seed is None else seed
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+        self.count = bin(int.from_bytes(self.bits, "little")).count("1")
+
+    @classmethod
+    def from_row(cls, row: tuple, owner):
+        """
+        :param row: asked_question row or `row()`
+        """
+        return cls((row[0], row[1]), row[2], owner, row[3], row[4], row[5])
+
+    def row(self):
+        return self.key[0], self.key[1], self.size, self.seed, self.position, bytes(self.bits)
+
+    def __contains__(self, index: int):
+        return self.bits[index >> 3] >> (index & 7) & 1
+
+    def add(self, index: int):
+        if index in self:
+            return
+        self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+        while self.position < self.size and permute(self.position, self.size, self.seed) in self:
+            self.position += 1
+        self.owner.changed(self, index)
+
+    def discard(self, index: int):
+        """
+        Give back a position which was taken but not asked, it's taken again first
+        """
+        if index not in self:
+            return
+        self.bits[index >> 3] &= ~(1 << (index & 7))
+        self.count -= 1
+        # the position is before the low-water mark, move the mark back to it
+        self.position = min(self.position, permute(index, self.size, self.seed, True))
+        self.owner.changed(self, index)
+
+    def reset(self):
+        """
+        Start a new cycle in a new random order
+        """
+        self.bits = bytearray(len(self.bits))
+        self.count = 0
+        self.position = 0
+        self.seed = random_seed()
+        self.owner.changed(self, None)
+
+    def take(self):
+        """
+        Reserve the next question which wasn't asked, see `discard`
+        :return: its position in the pool
+        """
+        if self.count >= self.size:
+            self.reset()
+        index = permute(self.position, self.size, self.seed)
+        while index in self:
+            self.position += 1
+            index = permute(self.position, self.size, self.seed)
+        self.add(index)
+        return index
+
+
+class AnswerMatcher(object):
+    """
+    Answer normalized and compiled once per question. Case, punctuation and ё/е don't matter,
+    answer must be a whole word (or words) of the message. Symbols inside a word of the answer
+    ("C++", "C#", "3.14") are significant and must be typed as they are
+    """
+    _fold = str.maketrans("ё", "е")
+    _punctuation = re.compile(r"[\W_]+")
+    _soft = "\"'«»“”()[].,!?;:"  # punctuation around words which doesn't matter
+    _joiners = re.compile(r"[-'’]")  # word separators which don't matter
+    _symbol = re.compile(r"[^\w]")
+
+    def __init__(self, answers: list):
+        words, exact, plain = [], [], []
+        for a in answers:
+            folded = a.casefold().translate(self._fold)
+            chunks = [c for c in (c.strip(self._soft) for c in folded.split()) if c]
+            normalized = self.normalize(a)
+            if any(self._symbol.search(self._joiners.sub("", c)) for c in chunks):
+                exact.append(r"\s+".join(re.escape(c) for c in chunks))
+            elif normalized:
+                words.append(re.escape(normalized))
+            elif folded.strip():
+                # answer has no letters or digits at all, fallback to the plain substring search
+                plain.append(re.escape(folded.strip()))
+        self.words = words and re.compile(r"(?<!\w)(?:{})(?!\w)".format("|".join(words)))
+        soft = re.escape(self._soft)
+        self.exact = exact and re.compile(r"(?<![^\s{0}])(?:{1})(?![^\s{0}])".format(soft, "|".join(exact)))
+        self.plain = plain and re.compile("|".join(plain))
+
+    @classmethod
+    def normalize(cls, text: str):
+        return " ".join(cls._punctuation.sub(" ", text.casefold().translate(cls._fold)).split())
+
+    def match(self, text: str):
+        if self.words and self.words.search(self.normalize(text)) is not None:
+            return True
+        if self.exact or self.plain:
+            folded = text.casefold().translate(self._fold)
+            if self.exact and self.exact.search(folded) is not None:
+                return True
+            if self.plain and self.plain.search(folded) is not None:
+                return True
+        return False
+
+
+class ChannelSender(object):
+    """
+    Outbound queue of a channel. Messages queued while the previous one is being sent are merged
+    into one request, typing indicators are dropped when a message is about to be sent anyway,
+    failed requests are retried after the delay Discord asks for
+    """
+
+    def __init__(self, bot, channel, metrics: Metrics):
+        self.bot = bot
+        self.channel = channel
+        self.metrics = metrics
+        self.queue = []
+        self.hold_until = 0
+        self.typing = False
+        self.typing_sent = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def send(self, content: str, hold: float = 0):
+        """
+        Queue a message
+        :param content:
+        :param hold: seconds the message may wait to be merged with the next one
+        """
+        self.queue.append(content)
+        self.hold_until = time.perf_counter() + hold if hold else 0
+        self._wake()
+
+    def send_typing(self):
+        if (self.queue and not self.hold_until) or time.perf_counter() - self.typing_sent < TYPING_INTERVAL:
+            self.metrics.inc("typing_dropped")
+            return
+        self.typing = True
+        self._wake()
+
+    def _wake(self):
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+
+    def _take(self):
+        """
+        :return: queued messages merged up to Discord's message length limit
+        """
+        content = self.queue.pop(0)
+        while self.queue and len(content) + len(self.queue[0]) + 2 <= MESSAGE_LIMIT:
+            content += "\n\n" + self.queue.pop(0)
+            self.metrics.inc("messages_merged")
+        return content
+
+    async def _run(self):
+        while self.queue or self.typing:
+            self.wakeup.clear()
+            if self.typing:
+                self.typing = False
+                self.typing_sent = time.perf_counter()
+                await self._request(self.bot.send_typing, self.channel)
+                continue
+            wait = self.hold_until - time.perf_counter()
+            if wait > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    self.hold_until = 0
+                continue
+            self.hold_until = 0
+            content = self._take()
+            self.typing_sent = 0  # a message ends the typing indicator
+            await self._request(self.bot.send_message, self.channel, content)
+
+    async def _request(self, fn, *args):
+        delay = SEND_RETRY_DELAY
+        for attempt in range(SEND_ATTEMPTS):
+            self.metrics.inc("send_requests")
+            try:
+                await fn(*args)
+                return True
+            except discord.Forbidden:
+                return False
+            except Exception as e:
+                if attempt + 1 == SEND_ATTEMPTS:
+                    print("ETrivia: can't send to {}: {}".format(self.channel.id, e))
+                    return False
+                self.metrics.inc("send_retries")
+                await asyncio.sleep(retry_after(e) or delay)
+                delay *= 2
+        return False
+
+
 class TriviaSession(object):
-    def __init__(self, message, settings, question_list, dbc):
+    def __init__(self, manager, message, settings, question_list, theme: str = None):
         self.gave_answer = ["I know this one! {}!", "Easy: {}.", "Oh really? It's {} of course."]
         self.current_q = None  # {"QUESTION" : "String", "ANSWER" : ""}
         self.masked_answer = ""
+        self.hints = []  # masks of the current answer, see hint_schedule
         self.hints_count = 0
         self.question_list = ""
         self.channel = message.channel
         self.score_list = {}
         self.status = None
         self.timer = None
+        self.timeout = time.perf_counter()  # time of the last message in the channel
+        self.wakeup = asyncio.Event()
         self.count = 0
         self.settings = settings
         self.question_list = question_list
-        self.dbc = dbc
+        self.theme = theme  # None in MIX_THEME games
+        self.dirty = False  # changed since the last snapshot
+        self.manager = manager
+        self.db = manager.db
+        self.ratings = manager.ratings
         self.server_id = message.server.id
+        self.prefetched = collections.deque()
+        self.prefetch_task = None
+        self.task = None
+        self.sender = ChannelSender(manager.bot, self.channel, manager.metrics)
 
-    def get_question(self, q_id: int):
-        c = self.dbc.cursor()
-        c.execute("SELECT * FROM question WHERE id=?", (q_id,))
-        q = c.fetchone()
+    def start(self, snapshot: dict = None):
+        """
+        Run the game loop in its own task
+        :param snapshot: continue the game saved by `snapshot`
+        :return: the task
+        """
+        self.task = asyncio.ensure_future(self.in_game(snapshot))
+        return self.task
+
+    def snapshot(self):
+        """
+        :return: JSON-serializable state of the game, see `restore`
+        """
+        self.dirty = False
+        ids = [q["id"] for q in self.prefetched]
+        asking = self.status == "waiting for answer" and self.current_q is not None
+        if asking:
+            ids.insert(0, self.current_q["id"])
         return {
-            'text': q[2],
-            'answer': q[3]
+            "c": self.channel.id,
+            "s": self.server_id,
+            "t": self.theme,
+            "m": self.theme is None,
+            "q": self.question_list.state(),
+            "p": [[user.id, user.name, score] for user, score in self.score_list.items()],
+            "n": self.count - 1 if asking else self.count,
+            "i": ids,
         }
 
-    def save_or_update_user(self, server_id: int, user, plus_games: int = 0, plus_answers: int = 0,
-                            plus_wins: int = 0):
-        self.dbc.execute("""
-        INSERT OR IGNORE INTO `rating` (server_id, user_id, username)
-        VALUES (
-            ?, ?, ?
-        )
-        """, (server_id, user.id, user.name))
-        self.dbc.execute("""
-        UPDATE `rating` SET total_games = total_games + ?, wins = wins + ?, right_answers = right_answers + ?
-        WHERE server_id=? AND user_id=?
-        """, (plus_games, plus_wins, plus_answers, server_id, user.id))
-        self.dbc.commit()
+    async def restore(self, snapshot: dict):
+        """
+        Continue the saved game, the unanswered question is asked again
+        """
+        self.question_list.restore(snapshot["q"], snapshot["i"])
+        self.score_list = {Player(p[0], p[1]): p[2] for p in snapshot["p"]}
+        self.count = snapshot["n"]
+        if snapshot["i"]:
+            questions = await self.db.get_questions(snapshot["i"])
+            self.prefetched.extend(questions[i] for i in snapshot["i"] if i in questions)
+        self.sender.send("Let's continue where we left off!")
 
-    async def in_game(self):
-        await self.new_question()
+    def cancel(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    async def in_game(self, snapshot: dict = None):
+        """
+        Game loop, one iteration per question
+        """
+        try:
+            if snapshot is not None:
+                await self.restore(snapshot)
+            while self.status != "stop" and await self.new_question():
+                await self.pause(QUESTION_PAUSE)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("ETrivia: game in {} failed: {}".format(self.channel.id, e))
+            traceback.print_exc()
+            self.sender.send("Something went wrong, the game is stopped.")
+        finally:
+            self.status = "stop"
+            self.question_list.release()
+            self.manager.remove_session(self)
+
+    async def pause(self, seconds: float):
+        """
+        Sleep between questions, interrupted when the game is stopped
+        """
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
 
     async def stop_etrivia(self):
+        if self.status == "stop":
+            return
         self.status = "stop"
-        etrivia_manager.etrivia_sessions.remove(self)
+        self.wakeup.set()
+        self.save_results()
+        self.manager.remove_session(self)
 
     async def end_game(self):
+        if self.status == "stop":
+            return
         self.status = "stop"
+        self.wakeup.set()
         if self.score_list:
             best_player = max(self.score_list.items(), key=operator.itemgetter(1))[0]
-            self.save_or_update_user(self.server_id, best_player, 0, 0, 1)
+            self.ratings.add(self.server_id, best_player, 0, 0, 1)
+            self.save_results(best_player)
             await self.send_table()
-        etrivia_manager.etrivia_sessions.remove(self)
+        await self.ratings.flush()
+        self.manager.remove_session(self)
+
+    def save_results(self, winner=None):
+        """
+        Add players' scores to the history of games
+        """
+        if self.score_list:
+            self.ratings.add_results(self.server_id, self.channel.id, self.theme,
+                                     [(user, score, user is winner) for user, score in self.score_list.items()])
+
+    async def prefetch(self):
+        """
+        Load the next batch of questions with a single query
+        """
+        ids = []
+        while self.question_list and len(ids) < QUESTION_PREFETCH:
+            q = self.question_list.pop()
+            if q is not None:
+                ids.append(q)
+        if ids:
+            metrics = self.manager.metrics
+            started = metrics.enabled and time.perf_counter()
+            questions = await self.db.get_questions(ids)
+            if started:
+                metrics.observe("get_questions", time.perf_counter() - started)
+            self.prefetched.extend(questions[i] for i in ids if i in questions)
+
+    async def next_question(self):
+        """
+        Take the next question from memory and refill the buffer in background when it runs low
+        :return: question or None if there are no questions left
+        """
+        if self.prefetch_task is not None and not self.prefetch_task.done():
+            await self.prefetch_task
+        while not self.prefetched and self.question_list:
+            await self.prefetch()
+        if not self.prefetched:
+            return None
+        q = self.prefetched.popleft()
+        if len(self.prefetched) < QUESTION_PREFETCH_LOW and self.question_list:
+            self.prefetch_task = asyncio.ensure_future(self.prefetch())
+        return q
 
     async def new_question(self):
+        """
+        Ask the next question and wait until it's answered, revealed or the game is stopped
+        :return: False if the game is over
+        """
         for score in self.score_list.values():
             if score == self.settings["ETRIVIA_MAX_SCORE"]:
                 await self.end_game()
-                return True
-        if not self.question_list:
+                return False
+        metrics = self.manager.metrics
+        started = metrics.enabled and time.perf_counter()
+        q = await self.next_question()
+        if started:
+            metrics.observe("next_question", time.perf_counter() - started)
+        if q is None:
             await self.end_game()
-            return True
-        q = self.question_list.pop()
-        while q is None and self.question_list:
-            q = self.question_list.pop()
+            return False
 
-        self.current_q = self.get_question(q)
-        self.masked_answer = ""
+        metrics.inc("questions")
+        self.current_q = q
+        self.question_list.shown(q["id"])
+        self.hints = hint_schedule(self.current_q["answer"], self.settings["ETRIVIA_HINT_RATIO"],
+                                   self.settings["ETRIVIA_HINT_MIN_HIDDEN"])
         self.hints_count = 0
-        for c in self.current_q["answer"]:
-            if c == ' ' or c == '-' or c == '(' or c == ')':
-                self.masked_answer += c
-            else:
-                self.masked_answer += '*'
+        self.masked_answer = self.hints[0]
 
         self.status = "waiting for answer"
         self.count += 1
-        self.timer = int(time.perf_counter())
+        self.dirty = True
+        self.timer = time.perf_counter()
+        self.wakeup.clear()
         msg = "**Вопрос №{}!**\n\n{} Букв: {}.".format(str(self.count), self.current_q["text"],
                                                        self.get_answer_length())
-        try:
-            await etrivia_manager.bot.say(msg)
-        except:
-            await asyncio.sleep(0.5)
-            await etrivia_manager.bot.say(msg)
+        self.sender.send(msg)
 
         while self.status == "waiting for answer":
-            if abs(self.timer - int(time.perf_counter())) >= self.settings["ETRIVIA_DELAY"]:
-                if self.masked_answer.count('*') > 2:
-                    self.timer = int(time.perf_counter())
+            now = time.perf_counter()
+            hint_at = self.timer + self.settings["ETRIVIA_DELAY"]
+            timeout_at = self.timeout + self.settings["ETRIVIA_TIMEOUT"]
+            if now >= hint_at:
+                if self.hints_count + 1 < len(self.hints):
+                    self.timer = now
                     await self.show_hint()
+                    continue
                 else:
                     self.status = "no answer"
                     break
-            else:
-                if abs(self.timeout - int(time.perf_counter())) >= self.settings["ETRIVIA_TIMEOUT"]:
-                    await etrivia_manager.bot.say("Guys...? Well, I guess I'll stop then.")
-                    await self.stop_etrivia()
-                    return True
-            await asyncio.sleep(1)  # Waiting for an answer or for the time limit
+            elif now >= timeout_at:
+                self.sender.send("Guys...? Well, I guess I'll stop then.")
+                await self.stop_etrivia()
+                return False
+            # Sleep until an answer arrives, a hint is due or the session times out
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), min(hint_at, timeout_at) - now)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
         if self.status == "correct answer":
             self.status = "new question"
-            await asyncio.sleep(3)
-            if not self.status == "stop":
-                await self.new_question()
         elif self.status == "stop":
-            return True
+            return False
         else:
             msg = randchoice(self.gave_answer).format(self.current_q["answer"])
             if self.settings["ETRIVIA_BOT_PLAYS"]:
                 msg += " **+1** for me!"
-                self.add_point(etrivia_manager.bot.user.name)
+                self.add_point(self.server_id, self.manager.bot.user)
             self.current_q["answer"] = ""
-            try:
-                await etrivia_manager.bot.say(msg)
-                await etrivia_manager.bot.send_typing(self.channel)
-            except:
-                await asyncio.sleep(0.5)
-                await etrivia_manager.bot.say(msg)
-            await asyncio.sleep(3)
-            if not self.status == "stop":
-                await self.new_question()
+            # held to be merged with the next question, players see typing indicator meanwhile
+            self.sender.send(msg, hold=QUESTION_PAUSE + 1)
+            self.sender.send_typing()
+        return True
 
     async def send_table(self):
         self.score_list = sorted(self.score_list.items(), reverse=True,
@@ -479,74 +2126,250 @@ class TriviaSession(object):
             t += str(score[1])  # score
             t += "\n"
         t += "```"
-        await etrivia_manager.bot.say(t)
+        self.sender.send(t)
 
     async def check_answer(self, message: discord.message.Message):
-        if message.author.id != etrivia_manager.bot.user.id:
+        if message.author.id != self.manager.bot.user.id:
             self.timeout = time.perf_counter()
             if self.current_q is not None and self.current_q["answer"] != "":
-                if self.current_q["answer"].lower() in message.content.lower():
+                metrics = self.manager.metrics
+                if metrics.enabled:
+                    matched = self.current_q["matcher"].match(message.content)
+                    metrics.observe("check_answer", time.perf_counter() - self.timeout)
+                    metrics.inc("answers_checked")
+                else:
+                    matched = self.current_q["matcher"].match(message.content)
+                if matched:
+                    metrics.inc("answers_correct")
                     self.current_q["answer"] = ""
                     self.status = "correct answer"
-                    self.add_point(message)
+                    self.wakeup.set()
+                    self.add_point(message.server.id, message.author)
                     msg = "You got it {}! **+1** to you!".format(message.author.name)
-                    try:
-                        await etrivia_manager.bot.send_typing(self.channel)
-                        await etrivia_manager.bot.send_message(message.channel, msg)
-                    except:
-                        await asyncio.sleep(0.5)
-                        await etrivia_manager.bot.send_message(message.channel, msg)
+                    self.sender.send(msg)
                     return True
 
     async def show_hint(self):
-        letters_count = 0
         self.hints_count += 1
-        number_sequence = []
-        for i, c in enumerate(self.masked_answer):
-            if c == '*':
-                number_sequence.append(i)
-                letters_count += 1
-
-        for x in range(0, math.ceil(letters_count / 5.0)):
-            i = randchoice(number_sequence)
-            number_sequence.remove(i)
-            letter_to_show = self.current_q["answer"][i]
-            self.masked_answer = self.masked_answer[:i] + letter_to_show + self.masked_answer[i + 1:]
+        self.masked_answer = self.hints[self.hints_count]
 
         msg = "**Подсказка №{}!** `{}`".format(self.hints_count, self.masked_answer)
 
-        try:
-            await etrivia_manager.bot.say(msg)
-            await etrivia_manager.bot.send_typing(self.channel)
-        except:
-            await asyncio.sleep(0.5)
-            await etrivia_manager.bot.say(msg)
+        self.sender.send(msg)
+        self.sender.send_typing()
 
     def get_answer_length(self):
         if self.current_q is not None:
             return len(self.current_q["answer"])
 
-    def add_point(self, message: discord.message.Message):
-        if message.author in self.score_list:
-            self.score_list[message.author] += 1
-            self.save_or_update_user(message.server.id, message.author, 0, 1)
+    def add_point(self, server_id: int, user):
+        self.dirty = True
+        if user in self.score_list:
+            self.score_list[user] += 1
+            self.ratings.add(server_id, user, 0, 1)
         else:
-            self.score_list[message.author] = 1
-            self.save_or_update_user(message.server.id, message.author, 1, 1)
+            self.score_list[user] = 1
+            self.ratings.add(server_id, user, 1, 1)
+
+
+class Player(object):
+    """
+    Player restored from a snapshot, equal to any user with the same id like discord's users
+    """
+    __slots__ = ("id", "name")
+
+    def __init__(self, id: str, name: str):
+        self.id = id
+        self.name = name
+
+    def __eq__(self, other):
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class ResumeMessage(object):
+    """
+    Stand-in for the message starting a game restored from its snapshot
+    """
+    __slots__ = ("channel", "server", "author", "content")
+
+    def __init__(self, channel, server):
+        self.channel = channel
+        self.server = server
+        self.author = None
+        self.content = ""
 
 
 async def get_trivia_by_channel(channel):
-    for t in etrivia_manager.etrivia_sessions:
-        if t.channel == channel:
-            return t
-    return False
+    return etrivia_manager.get_session(channel) or await etrivia_manager.resume(channel) or False
 
 
 async def check_messages(message):
-    if message.author.id != etrivia_manager.bot.user.id:
-        if await get_trivia_by_channel(message.channel):
-            trvsession = await get_trivia_by_channel(message.channel)
-            await trvsession.check_answer(message)
+    sessions = etrivia_manager.etrivia_sessions
+    if not sessions and not etrivia_manager.suspended:
+        return
+    trvsession = sessions.get(message.channel.id)
+    if trvsession is None and message.channel.id in etrivia_manager.suspended:
+        await etrivia_manager.resume(message.channel)
+        return
+    if trvsession is not None and message.author.id != etrivia_manager.bot.user.id:
+        await trvsession.check_answer(message)
+
+
+def retry_after(e: Exception):
+    """
+    :return: seconds to wait according to the rate limit response, None if it's not a rate limit error
+    """
+    response = getattr(e, "response", None)
+    if response is None or getattr(response, "status", None) != 429:
+        return None
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if "X-RateLimit-Reset-After" in headers:
+            return float(headers["X-RateLimit-Reset-After"])
+        if "Retry-After" in headers:
+            return float(headers["Retry-After"]) / 1000.0  # milliseconds in API v6
+    except ValueError:
+        pass
+    return None
+
+
+def rating_row(r):
+    return {"server_id": r[0], "user_id": r[1], "username": r[2], "games": r[3], "wins": r[4], "answers": r[5]}
+
+
+def rating_with_delta(rating: dict, delta: list):
+    """
+    :param delta: [username, games, wins, answers] buffered by `RatingWriter`
+    :return: new rating dict
+    """
+    return {"server_id": rating["server_id"], "user_id": rating["user_id"], "username": delta[0],
+            "games": rating["games"] + delta[1], "wins": rating["wins"] + delta[2],
+            "answers": rating["answers"] + delta[3]}
+
+
+def make_question(text: str, answer: str, q_id: int = None):
+    """
+    :param text: Question's text
+    :param answer: Answer, alternative answers are separated with "`"
+    :param q_id: Question's id
+    :return: question dict, `answer` is the first alternative
+    """
+    answers = [a.strip() for a in answer.split("`") if a.strip()] or [answer]
+    return {
+        'id': q_id,
+        'text': text,
+        'answer': answers[0],
+        'matcher': AnswerMatcher(answers)
+    }
+
+
+def random_seed():
+    """
+    :return: key of `permute`, fits sqlite's INTEGER
+    """
+    return random.getrandbits(62)
+
+
+def permute(i: int, n: int, seed: int, inverse: bool = False):
+    """
+    Keyed pseudo-random permutation of range(n): a 4-round Feistel network over the smallest
+    even power of two >= n, results out of range are permuted again until they fit
+    :param inverse: map back, permute(permute(i, n, seed), n, seed, True) == i
+    :return: i-th element of the permutation
+    """
+    if n <= 1:
+        return i
+    half = ((n - 1).bit_length() + 1) // 2
+    mask = (1 << half) - 1
+    rounds = (3, 2, 1, 0) if inverse else (0, 1, 2, 3)
+    while True:
+        left, right = i >> half, i & mask
+        for r in rounds:
+            key = seed >> (r * 16) & 0xffff
+            if inverse:
+                left, right = right ^ ((left * 0x9e3779b1 + key) * 0x85ebca6b >> 15 & mask), left
+            else:
+                left, right = right, left ^ ((right * 0x9e3779b1 + key) * 0x85ebca6b >> 15 & mask)
+        i = left << half | right
+        if i < n:
+            return i
+
+
+def hint_schedule(answer: str, ratio: float, min_hidden: int):
+    """
+    :param answer: Answer to hide
+    :param ratio: Part of the hidden letters revealed by each hint
+    :param min_hidden: Hints stop when this many letters or less are hidden
+    :return: list of masks, the first one hides every letter, each next one is the following hint
+    """
+    mask = [c if c in HINT_SHOWN else '*' for c in answer]
+    hidden = [i for i, c in enumerate(mask) if c == '*']
+    random.shuffle(hidden)  # reveal order, letters are popped from the end
+    hints = ["".join(mask)]
+    while len(hidden) > min_hidden:
+        for x in range(min(max(1, math.ceil(len(hidden) * ratio)), len(hidden) - min_hidden)):
+            i = hidden.pop()
+            mask[i] = answer[i]
+        hints.append("".join(mask))
+    return hints
+
+
+def guess_encoding(trivia_list):
+    with open(trivia_list, "rb") as f:
+        try:
+            encoding = chardet.detect(f.read(ENCODING_SAMPLE))["encoding"]
+        except:
+            return "ISO-8859-1"
+    if encoding is None or encoding == "ascii":
+        # only the beginning of the file was checked, utf-8 is the safe superset of ascii
+        return "utf-8"
+    return encoding
+
+
+def file_digest(file_name: str):
+    h = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for chunk in iter(functools.partial(f.read, 1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_theme_file(file_name: str, digest: str = None):
+    """
+    Runs in a worker process of `loadall`
+    :param file_name:
+    :param digest: hash of the previously imported content
+    :return: (size, mtime, hash, questions), questions is None if content didn't change
+    """
+    st = os.stat(file_name)
+    new_digest = file_digest(file_name)
+    if new_digest == digest:
+        return st.st_size, st.st_mtime, new_digest, None
+    return st.st_size, st.st_mtime, new_digest, list(parse_theme_file(file_name))
+
+
+def parse_theme_file(file_name: str, stats: list = None):
+    """
+    Generator of (question, answer) pairs from the theme's file, the file is never fully loaded in memory
+    :param file_name:
+    :param stats: optional list [lines, questions] updated while parsing
+    """
+    encoding = guess_encoding(file_name)
+    with open(file_name, "r", encoding=encoding, errors="replace") as fin:
+        for line in fin:
+            if stats is not None:
+                stats[0] += 1
+            if "`" in line and len(line) > 4:
+                line = line.rstrip("\r\n").split("`")
+                question = line[0]
+                answer = "`".join(a for a in line[1:] if a.strip())
+                if answer:
+                    if stats is not None:
+                        stats[1] += 1
+                    yield question, answer
 
 
 def check_folders():
@@ -558,11 +2381,20 @@ def check_folders():
 
 
 def check_files():
-    settings = {"ETRIVIA_MAX_SCORE": 10, "ETRIVIA_TIMEOUT": 120, "ETRIVIA_DELAY": 10, "ETRIVIA_BOT_PLAYS": False}
+    settings = {"ETRIVIA_MAX_SCORE": 10, "ETRIVIA_TIMEOUT": 120, "ETRIVIA_DELAY": 10, "ETRIVIA_BOT_PLAYS": False,
+                "ETRIVIA_METRICS": False,
+                "ETRIVIA_HINT_RATIO": 0.2, "ETRIVIA_HINT_MIN_HIDDEN": 2}
 
     if not os.path.isfile("data/etrivia/settings.json"):
         print("Creating empty settings.json...")
         dataIO.save_json("data/etrivia/settings.json", settings)
+    else:
+        current = dataIO.load_json("data/etrivia/settings.json")
+        missing = {k: v for k, v in settings.items() if k not in current}
+        if missing:
+            print("Adding new settings to settings.json...")
+            current.update(missing)
+            dataIO.save_json("data/etrivia/settings.json", current)
 
 
 def setup(bot):